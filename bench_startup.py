@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# Time how long Popper takes to start up (parse the bias and ground the generator) on a set of tasks
+# e.g. python bench_startup.py chess examples/iggp-*
+# With --imports, check with -X importtime that importing Popper does not pull in heavy modules
+# e.g. python bench_startup.py --imports
+
+import sys
+import glob
+import argparse
+import subprocess
+from time import perf_counter
+from popper.bias import Bias
+from popper.util import Settings
+from popper.generate import Generator, Grounder
+
+DEFAULT_KBPATHS = ['chess'] + sorted(glob.glob('examples/iggp-*'))
+# only imported once they are needed, so must not be imported at start up
+LAZY_MODULES = ['numpy', 'pkg_resources', 'pyswip']
+
+def time_imports(module):
+    cmd = [sys.executable, '-X', 'importtime', '-c', f'import {module}']
+    out = subprocess.run(cmd, capture_output=True, text=True).stderr
+    times = {}
+    for line in out.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _self_time, cumulative_time, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative_time)
+    return times
+
+def check_imports(module, repeats, max_ms):
+    times = [time_imports(module) for _ in range(repeats)]
+    total = min(t.get(module, 0) for t in times) / 1000
+    print(f'import {module}: {total:.1f}ms')
+    ok = True
+    for name in LAZY_MODULES:
+        if any(name in t for t in times):
+            print(f'{name} is imported at start up')
+            ok = False
+    if max_ms != None and total > max_ms:
+        print(f'import time exceeds {max_ms}ms')
+        ok = False
+    return ok
+
+def time_startup(kbpath):
+    sys.argv = ['popper.py', kbpath, '-q']
+
+    t1 = perf_counter()
+    settings = Settings()
+    t2 = perf_counter()
+    Bias(settings.bias_file)
+    t3 = perf_counter()
+    Generator(settings, Grounder())
+    t4 = perf_counter()
+
+    return t2 - t1, t3 - t2, t4 - t3
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Popper start up')
+    parser.add_argument('kbpaths', nargs='*', default=DEFAULT_KBPATHS, help='Paths to the tasks')
+    parser.add_argument('-n', '--repeats', type=int, default=5, help='Number of times to start up on each task')
+    parser.add_argument('--imports', default=False, action='store_true', help='Check the import time of Popper instead')
+    parser.add_argument('--max-import-ms', type=float, default=None, help='Fail if importing Popper takes longer than this')
+    args = parser.parse_args()
+
+    if args.imports:
+        sys.exit(0 if check_imports('popper.loop', args.repeats, args.max_import_ms) else 1)
+
+    print(f'{"task":<40} {"settings":>10} {"bias":>10} {"generator":>10}')
+    for kbpath in args.kbpaths:
+        times = [time_startup(kbpath) for _ in range(args.repeats)]
+        settings_t, bias_t, generator_t = (min(ts) for ts in zip(*times))
+        print(f'{kbpath:<40} {settings_t:>10.4f} {bias_t:>10.4f} {generator_t:>10.4f}')
@@ -0,0 +1,135 @@
+# Learn many tasks in parallel, one process per task, and write one JSON line per task.
+# Options after -- are passed to every task, e.g.
+#   popper-batch examples/iggp-* -j 4 --timeout 60 --memory-limit 4096 -o results.jsonl -- --max-body 4
+# Tasks that took longest in earlier runs (read from the output file) are started first.
+# Each task stops at its own --timeout through Popper's deadline and is killed GRACE_PERIOD seconds after it.
+# With --memory-limit, a task that dies without a result is reported as out of memory, as going over the limit
+# usually makes an allocation in clingo or SWI-Prolog fail rather than raise a MemoryError.
+
+import os
+import sys
+import json
+import argparse
+import resource
+import multiprocessing
+import multiprocessing.connection
+from time import perf_counter
+from . util import Settings, prog_score_to_dict, TIMEOUT
+from . loop import learn_solution
+
+OUTPUT_FILE='results.jsonl'
+# how long after its timeout a task is killed, to give Popper the chance to stop by itself
+GRACE_PERIOD=10
+
+def parse_args(argv=None):
+    if argv == None:
+        argv = sys.argv[1:]
+    popper_args = []
+    if '--' in argv:
+        i = argv.index('--')
+        argv, popper_args = argv[:i], argv[i+1:]
+
+    parser = argparse.ArgumentParser(description='Learn many Popper tasks in parallel', epilog='Options after -- are passed to every task')
+    parser.add_argument('kbpaths', nargs='+', help='Paths to the tasks')
+    parser.add_argument('-o', '--output', type=str, default=OUTPUT_FILE, help=f'JSONL file to append results to (default: {OUTPUT_FILE})')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of tasks to run at once (default: number of CPUs)')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT, help=f'Maximum learning time per task in seconds (default: {TIMEOUT})')
+    parser.add_argument('--memory-limit', type=int, default=None, help='Maximum memory per task in MB')
+    parser.add_argument('--tactic-dir', type=str, default=None, help='Directory to write the tactics of each task to (default: discard them)')
+    args = parser.parse_args(argv)
+    args.popper_args = popper_args
+    return args
+
+def load_runtimes(path):
+    # the runtime of the most recent run of each task
+    runtimes = {}
+    if not os.path.isfile(path):
+        return runtimes
+    with open(path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+                runtimes[result['kbpath']] = result['runtime']
+            except (json.JSONDecodeError, KeyError, TypeError):
+                continue
+    return runtimes
+
+def schedule(kbpaths, runtimes, timeout):
+    # longest expected first, assuming that tasks never run before take the full timeout
+    return sorted(kbpaths, key=lambda kbpath: (-runtimes.get(kbpath, timeout), kbpath))
+
+def task_argv(kbpath, args):
+    if args.tactic_dir:
+        tactic_file = os.path.join(args.tactic_dir, os.path.basename(os.path.normpath(kbpath)) + '.txt')
+    else:
+        tactic_file = os.devnull
+    return [kbpath, '--timeout', str(args.timeout), '--tactic-file', tactic_file] + args.popper_args
+
+def run_task(argv, memory_limit, conn):
+    if memory_limit:
+        limit = memory_limit * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    try:
+        settings = Settings(argv=argv)
+        prog, score, stats = learn_solution(settings)
+        result = prog_score_to_dict(prog, score)
+        # a task that stops at its own timeout is reported as a timeout too, along with the best program it found
+        result.update(status='timeout' if stats.timed_out else 'ok', stats=stats.to_dict())
+    except MemoryError:
+        result = {'status': 'memory'}
+    except (Exception, SystemExit) as e:
+        result = {'status': 'error', 'error': f'{type(e).__name__}: {e}'}
+    conn.send(result)
+
+def run_batch(args):
+    if args.tactic_dir:
+        os.makedirs(args.tactic_dir, exist_ok=True)
+
+    pending = schedule(args.kbpaths, load_runtimes(args.output), args.timeout)
+    pending.reverse()
+    # maps the connection of each running task to its process, kbpath, and start time
+    running = {}
+
+    with open(args.output, 'a') as f:
+        def finish(conn, result):
+            process, kbpath, start = running.pop(conn)
+            process.join(timeout=1)
+            if process.is_alive():
+                process.kill()
+                process.join()
+            result = dict(kbpath=kbpath, runtime=perf_counter() - start, **result)
+            if result['status'] == 'error' and 'error' not in result:
+                if args.memory_limit and process.exitcode != 0:
+                    result['status'] = 'memory'
+                result['error'] = f'exited with code {process.exitcode}'
+            f.write(json.dumps(result) + '\n')
+            f.flush()
+            print(f'{kbpath}: {result["status"]} in {result["runtime"]:0.2f}s', file=sys.stderr)
+
+        while pending or running:
+            while pending and len(running) < args.jobs:
+                kbpath = pending.pop()
+                conn, child_conn = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(target=run_task, args=(task_argv(kbpath, args), args.memory_limit, child_conn))
+                process.start()
+                child_conn.close()
+                running[conn] = (process, kbpath, perf_counter())
+
+            for conn in multiprocessing.connection.wait(list(running), timeout=1):
+                try:
+                    result = conn.recv()
+                except EOFError:
+                    result = {'status': 'error'}
+                finish(conn, result)
+
+            now = perf_counter()
+            for conn, (process, _kbpath, start) in list(running.items()):
+                if now - start > args.timeout + GRACE_PERIOD:
+                    process.kill()
+                    finish(conn, {'status': 'timeout'})
+
+def main():
+    run_batch(parse_args())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import clingo
+
+TIDY_OUTPUT = """
+#defined body_literal/4.
+#defined clause/1.
+#defined clause_var/2.
+#defined var_type/3.
+#defined body_size/2.
+#defined recursive/0.
+#defined var_in_literal/4.
+"""
+
+class Bias:
+    def __init__(self, bias_file):
+        with open(bias_file) as f:
+            self.text = f.read()
+
+        solver = clingo.Control()
+        solver.add('bias', [], self.text)
+        solver.add('bias', [], TIDY_OUTPUT)
+        solver.ground([('bias', [])])
+
+        self.head_preds = set(pred_arity(x.symbol) for x in solver.symbolic_atoms.by_signature('head_pred', arity=2))
+        self.body_preds = set(pred_arity(x.symbol) for x in solver.symbolic_atoms.by_signature('body_pred', arity=2))
+
+        # a predicate can have several type and direction declarations, such as one for each arity
+        self.types = {}
+        for x in solver.symbolic_atoms.by_signature('type', arity=2):
+            pred, types = x.symbol.arguments
+            self.types.setdefault(pred.name, []).append(tuple(str(t) for t in types.arguments))
+
+        self.directions = {}
+        for x in solver.symbolic_atoms.by_signature('direction', arity=2):
+            pred, directions = x.symbol.arguments
+            self.directions.setdefault(pred.name, []).append(tuple(str(d) for d in directions.arguments))
+
+        self.max_body = get_limit(solver, 'max_body')
+        self.max_vars = get_limit(solver, 'max_vars')
+        self.max_clauses = get_limit(solver, 'max_clauses')
+
+        self.recursion_enabled = any(True for _ in solver.symbolic_atoms.by_signature('enable_recursion', arity=0))
+        self.pi_enabled = any(True for _ in solver.symbolic_atoms.by_signature('enable_pi', arity=0))
+
+def pred_arity(symbol):
+    pred, arity = symbol.arguments
+    return pred.name, arity.number
+
+def get_limit(solver, name):
+    limit = None
+    for x in solver.symbolic_atoms.by_signature(name, arity=1):
+        limit = x.symbol.arguments[0].number
+    return limit
@@ -1,8 +1,16 @@
+import os
 import clingo
-import clingo.script
+from collections import defaultdict
+from itertools import combinations
+from multiprocessing import Pool
 from . core import Literal
+from . util import file_hash, lp_path
 from clingo import Function, Number, Tuple_
 
+CACHE_DIR = '.popper_cache'
+# the cons.pl program parts and how many predicates their props are about
+PART_SIZES = {'single':1, 'pair':2, 'triple':3}
+
 # tmp_map = {1:'A', 2:'A,B',3:'A,B,C', 4:'A,B,C,D',5:'A,B,C,D,E', 6:'A,B,C,D,E,F'}
 tmp_map = {}
 for i in range(1,20):
@@ -20,31 +28,23 @@ TIDY_OUTPUT = """
 """
 
 def get_body_preds(settings):
-    solver = clingo.Control()
-    with open(settings.bias_file) as f:
-        solver.add('bias', [], f.read())
-    solver.add('bias', [], TIDY_OUTPUT)
-    solver.ground([('bias', [])])
-
-    for x in solver.symbolic_atoms.by_signature('head_pred', arity=2):
-        args = x.symbol.arguments
-        symbol = args[0].name
-        arity = args[1].number
-        head_pred = symbol, arity
-
-    head_pred, head_arity=  head_pred
-    head_literal = Literal(head_pred, tuple(arg_lookup[clingo.Number(arg)] for arg in range(head_arity)))
-    head_str =  f'{head_pred}({tmp_map[head_arity]})'
-
-    body_preds = set()
-    for x in solver.symbolic_atoms.by_signature('body_pred', arity=2):
-        args = x.symbol.arguments
-        symbol = args[0]
-        arity = args[1].number
-        body_preds.add((symbol, arity))
-    return body_preds
+    return settings.bias.body_preds
+
+def bkcons_cache_path(settings, cons_path):
+    cache_dir = os.path.join(os.path.dirname(settings.bk_file), CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    k = file_hash(settings.bk_file, settings.bias_file, cons_path)
+    return os.path.join(cache_dir, f'bkcons-{k}.pl')
 
 def deduce_bk_cons(settings):
+    cons_path = lp_path('cons.pl')
+    path = bkcons_cache_path(settings, cons_path)
+
+    if os.path.isfile(path):
+        with open(path) as f:
+            settings.bkcons = f.read()
+        return
+
     prog = []
     lookup2 = {k: f'({v})' for k,v in tmp_map.items()}
     lookup1 = {k:v for k,v in lookup2.items()}
@@ -57,46 +57,101 @@ def deduce_bk_cons(settings):
         prog.append(rule)
     prog = '\n'.join(prog)
 
-    with open(settings.bias_file) as f:
-        bias = f.read()
+    bias = settings.bias.text
     with open(settings.bk_file) as f:
         bk = f.read()
-    with open('popper/lp/cons.pl') as f:
+    with open(cons_path) as f:
         cons = f.read()
 
     bk = bk.replace('\+','not')
 
-    xs = deduce_bk_cons_aux(cons, prog, bias, bk)
-    # for x in xs:
-        # x += '.'
-        # print(x)
-
-    settings.bkcons = '\n'.join(x + '.' for x in xs)
-
-    # print('intersection')
-    # for x in sorted(list(all_props)):
-    #     print(str(x) +  '.')
-
-    # print('counts')
-    # for k, vs in all_counts.items():
-    #     if len(vs) == 1:
-    #         continue
-    #     print(f'prop(countk,{k},{max(vs)}).')
-    #     # print(str(x) +  '.')
-
-    # exit()
-
-def deduce_bk_cons_aux(cons, prog, bias, bk):
-    encoding = [cons, prog, bias, bk, TIDY_OUTPUT]
+    processes = os.cpu_count() or 1
+    if processes == 1:
+        xs = {str(atom) for atom in deduce_bk_cons_aux(cons, prog, bias, bk, tuple(PART_SIZES))}
+    else:
+        xs = deduce_bk_cons_parallel(cons, prog, bias, bk, body_preds, settings.bias.types, processes)
+
+    settings.bkcons = '\n'.join(sorted(x + '.' for x in xs))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(settings.bkcons)
+    os.replace(tmp_path, path)
+
+def deduce_bk_cons_parallel(cons, prog, bias, bk, body_preds, types, processes):
+    # evaluate the bk once, then check the props over each group of predicates and each pair of groups on their own
+    holds = deduce_holds(prog, bias, bk)
+    preds = sorted(p for p, _a in body_preds)
+    groups = [frozenset(preds[i::processes]) for i in range(min(processes, len(preds)))]
+    jobs = [(('single', 'pair'), (g,)) for g in groups]
+    jobs.extend((('pair',), gs) for gs in combinations(groups, 2))
+    triple_preds = frozenset(p for triple in get_typed_triples(types) for p in triple)
+    if triple_preds:
+        jobs.append((('triple',), (triple_preds,)))
+    jobs = [(cons, bias, parts, gs, '\n'.join(fact for g in gs for p in g for fact in holds[p])) for parts, gs in jobs]
+
+    xs = set()
+    with Pool(processes) as pool:
+        for out in pool.imap_unordered(deduce_bk_cons_job, jobs):
+            xs.update(out)
+    return xs
+
+def deduce_holds(prog, bias, bk):
+    encoding = [prog, bias, bk, TIDY_OUTPUT, '#show holds/2.']
     encoding = '\n'.join(encoding)
     solver = clingo.Control()
     solver.add('base', [], encoding)
     solver.ground([('base', [])])
+    holds = defaultdict(set)
+    with solver.solve(yield_=True) as handle:
+        for m in handle:
+            for atom in m.symbols(shown = True):
+                holds[str(atom.arguments[0])].add(str(atom) + '.')
+    return holds
+
+def get_typed_triples(types):
+    # pre_postcon is the only prop over three predicates and needs types
+    triples = set()
+    types = [(p, ts) for p, decls in types.items() for ts in decls]
+    for p, ps in types:
+        for q, qs in types:
+            for r, rs in types:
+                if len(ps) == 1 and len(qs) == 2 and len(rs) == 1 and ps[0] == qs[0] and qs[1] == rs[0]:
+                    triples.add((p, q, r))
+    return sorted(triples)
+
+def prop_preds(atom):
+    preds = []
+    for arg in atom.arguments[1:]:
+        if arg.type == clingo.SymbolType.Function and arg.name == '':
+            preds.extend(str(x) for x in arg.arguments)
+        elif arg.type == clingo.SymbolType.Function:
+            preds.append(str(arg))
+    return preds
+
+def deduce_bk_cons_job(job):
+    cons, bias, parts, groups, holds = job
+    sizes = {PART_SIZES[part] for part in parts}
+    allowed = frozenset().union(*groups)
+    # only keep the props whose predicates all have their holds in this job and are not checked by another job
+    out = set()
+    for atom in deduce_bk_cons_aux(cons, holds, bias, '', parts):
+        preds = prop_preds(atom)
+        if len(preds) in sizes and allowed.issuperset(preds) and all(g.intersection(preds) for g in groups):
+            out.add(str(atom))
+    return out
+
+def deduce_bk_cons_aux(cons, prog, bias, bk, parts):
+    encoding = [prog, bias, bk, TIDY_OUTPUT]
+    encoding = '\n'.join(encoding)
+    solver = clingo.Control()
+    solver.add('base', [], cons)
+    solver.add('base', [], encoding)
+    solver.ground([('base', [])] + [(part, []) for part in parts])
     out = set()
     with solver.solve(yield_=True) as handle:
         for m in handle:
             for atom in m.symbols(shown = True):
                 if atom.name == 'prop':
-                    # print(str(atom) + '.')
-                    out.add(str(atom))
-    return out
\ No newline at end of file
+                    out.add(atom)
+    return out
@@ -1,6 +1,7 @@
 import clingo
 import time
 import itertools
+from . memory import SpillDict
 from . util import format_rule, prog_size, format_prog, flatten, reduce_prog, prog_is_recursive, rule_size, rule_is_recursive, order_rule
 
 # for when we have a complete solution
@@ -33,14 +34,16 @@ def get_rule_hash(rule):
     return hash((head, body))
 
 class Combiner:
-    def __init__(self, settings, tester):
+    def __init__(self, settings, tester, deadline=None):
         self.settings = settings
         self.tester = tester
+        self.deadline = deadline
 
         self.example_to_id = {}
         self.build_example_encoding()
 
-        self.prog_coverage = {}
+        # maps the sorted rule ids of each program to the examples it covers, as a bitset over example ids
+        self.prog_coverage = SpillDict()
 
         self.solution_found = False
         self.best_prog = None
@@ -49,8 +52,9 @@ class Combiner:
 
         self.constraints = set()
         self.rulehash_to_id = {}
-        self.ruleid_to_rule = {}
+        self.ruleid_to_rule = SpillDict()
         self.ruleid_to_size = {}
+        self.recursive_rules = set()
 
         self.inconsistent = set()
         self.debug_count = 0
@@ -63,8 +67,7 @@ class Combiner:
         self.example_prog = '\n'.join(example_prog)
 
     def update_prog_index(self, prog, pos_covered):
-        self.prog_coverage[prog] = pos_covered
-
+        rule_ids = []
         for rule in prog:
             rule_hash = get_rule_hash(rule)
             if rule_hash not in self.rulehash_to_id:
@@ -72,6 +75,18 @@ class Combiner:
                 self.rulehash_to_id[rule_hash] = k
                 self.ruleid_to_rule[k] = rule
                 self.ruleid_to_size[k] = rule_size(rule)
+                if rule_is_recursive(rule):
+                    self.recursive_rules.add(k)
+            rule_ids.append(self.rulehash_to_id[rule_hash])
+
+        covered = 0
+        for ex in pos_covered:
+            covered |= 1 << self.example_to_id[ex]
+        self.prog_coverage[tuple(sorted(set(rule_ids)))] = covered
+
+    def stored_progs(self):
+        for rule_ids, _covered in self.prog_coverage.items():
+            yield [self.ruleid_to_rule[k] for k in rule_ids]
 
     def add_inconsistent(self, prog):
         self.inconsistent.add(prog)
@@ -92,8 +107,16 @@ class Combiner:
             model_found = False
             model_inconsistent = False
 
-            with solver.solve(yield_=True) as handle:
-                for m in handle:
+            with solver.solve(yield_=True, async_=True) as handle:
+                while True:
+                    handle.resume()
+                    # out of time, so settle for the best combination so far
+                    if self.deadline and not handle.wait(self.deadline.phase_remaining('combine')):
+                        handle.cancel()
+                        return best_prog, best_fn
+                    m = handle.model()
+                    if m is None:
+                        break
                     model_found = True
                     model_incomplete = False
 
@@ -154,23 +177,21 @@ class Combiner:
             rule_id = self.rulehash_to_id[rule_hash]
             encoding.add(f'uses_new:- rule({rule_id}).')
 
-        for prog, examples_covered in self.prog_coverage.items():
-            prog_rules = set()
-            for rule in prog:
-                rule_hash = get_rule_hash(rule)
-                rule_id = self.rulehash_to_id[rule_hash]
+        # once over the memory budget, the programs spilled to disk are read back here on every call
+        for prog_rules, examples_covered in self.prog_coverage.items():
+            for rule_id in prog_rules:
                 rule_size = self.ruleid_to_size[rule_id]
-                prog_rules.add(rule_id)
                 encoding.add(f'size({rule_id},{rule_size}).')
-                if rule_is_recursive(rule):
+                if rule_id in self.recursive_rules:
                     encoding.add(f'recursive:- rule({rule_id}).')
                 else:
                     encoding.add(f'base:- rule({rule_id}).')
 
             prog_rules = ','.join(f'rule({i})' for i in prog_rules)
-            for ex in self.prog_coverage[prog]:
-                i = self.example_to_id[ex]
-                encoding.add(f'covered({i}):- {prog_rules}.')
+            while examples_covered:
+                low = examples_covered & -examples_covered
+                encoding.add(f'covered({low.bit_length() - 1}):- {prog_rules}.')
+                examples_covered ^= low
 
         # add example atoms
         encoding.add(self.example_prog)
@@ -0,0 +1,159 @@
+# Serve learning jobs from a long-lived process that keeps the bk and examples of each task loaded between jobs.
+# A job is a JSON object on one line, with the same arguments as popper.py:
+#   {"id": 1, "args": ["examples/trains1", "--max-body", "4"]}
+# and each job gets a JSON result on one line.
+# Jobs are read from stdin, or from a Unix socket with --socket PATH:
+#   python -m popper.daemon --socket /tmp/popper.sock
+
+import os
+import sys
+import json
+import argparse
+import socketserver
+import multiprocessing
+from time import perf_counter
+from collections import OrderedDict
+from . util import Settings, file_hash, prog_score_to_dict
+from . loop import learn_solution
+
+MAX_LOADED=4
+
+# the settings the tester is built with, so a loaded tester can only be reused if they are the same
+TESTER_SETTINGS = ('max_examples', 'eval_timeout', 'eval_inferences', 'tabling', 'qlf_cache', 'recursion_enabled', 'order_by_cost', 'datalog', 'cegis', 'prefix_cache_mb')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve Popper learning jobs, keeping the bk and examples loaded between jobs')
+    parser.add_argument('--socket', type=str, default=None, help='Path of the Unix socket to serve jobs on (default: read jobs from stdin)')
+    parser.add_argument('--max-loaded', type=int, default=MAX_LOADED, help=f'Maximum number of tasks kept loaded (default: {MAX_LOADED})')
+    return parser.parse_args()
+
+def task_key(settings):
+    extra = repr(tuple(getattr(settings, x) for x in TESTER_SETTINGS))
+    return file_hash(settings.bk_file, settings.ex_file, extra=extra)
+
+def run_job(argv, tester):
+    # imported here so that the daemon itself never starts SWI-Prolog
+    from . tester import Tester
+
+    t1 = perf_counter()
+    settings = Settings(argv=argv)
+    reused = tester != None
+    if reused:
+        tester.reuse(settings)
+    else:
+        tester = Tester(settings)
+    t2 = perf_counter()
+    prog, score, _stats = learn_solution(settings, tester)
+    t3 = perf_counter()
+
+    result = prog_score_to_dict(prog, score)
+    result.update(reused=reused, setup_time=t2 - t1, search_time=t3 - t2)
+    return tester, result
+
+def worker(conn):
+    # each task gets its own process as SWI-Prolog has a single database per process
+    tester = None
+    while True:
+        argv = conn.recv()
+        if argv == None:
+            return
+        try:
+            tester, result = run_job(argv, tester)
+        except (Exception, SystemExit) as e:
+            result = {'error': f'{type(e).__name__}: {e}'}
+        conn.send(result)
+
+class Daemon:
+    def __init__(self, max_loaded=MAX_LOADED):
+        self.max_loaded = max_loaded
+        # maps a task key to the process that has it loaded, in LRU order
+        self.workers = OrderedDict()
+
+    def get_worker(self, k):
+        if k in self.workers:
+            self.workers.move_to_end(k)
+            return self.workers[k]
+        if len(self.workers) >= self.max_loaded:
+            _, (process, conn) = self.workers.popitem(last=False)
+            self.stop_worker(process, conn)
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=worker, args=(child_conn,), daemon=True)
+        process.start()
+        self.workers[k] = (process, conn)
+        return process, conn
+
+    def stop_worker(self, process, conn):
+        try:
+            conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        process.join(timeout=1)
+        if process.is_alive():
+            process.terminate()
+
+    def run(self, job):
+        result = self.run_aux(job)
+        result['id'] = job.get('id')
+        return result
+
+    def run_aux(self, job):
+        argv = [str(arg) for arg in job.get('args', [])]
+        try:
+            k = task_key(Settings(argv=argv))
+        except (Exception, SystemExit) as e:
+            return {'error': f'{type(e).__name__}: {e}'}
+        process, conn = self.get_worker(k)
+        try:
+            conn.send(argv)
+            return conn.recv()
+        except (EOFError, BrokenPipeError, OSError):
+            del self.workers[k]
+            self.stop_worker(process, conn)
+            return {'error': f'worker exited with code {process.exitcode}'}
+
+    def run_line(self, line):
+        try:
+            job = json.loads(line)
+        except json.JSONDecodeError as e:
+            return {'id': None, 'error': f'JSONDecodeError: {e}'}
+        return self.run(job)
+
+    def close(self):
+        for process, conn in self.workers.values():
+            self.stop_worker(process, conn)
+        self.workers.clear()
+
+def serve_stdin(daemon):
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        print(json.dumps(daemon.run_line(line)), flush=True)
+
+def serve_socket(daemon, path):
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                result = daemon.run_line(line)
+                self.wfile.write((json.dumps(result) + '\n').encode())
+                self.wfile.flush()
+
+    with socketserver.UnixStreamServer(path, Handler) as server:
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(path)
+
+if __name__ == '__main__':
+    args = parse_args()
+    daemon = Daemon(args.max_loaded)
+    try:
+        if args.socket:
+            serve_socket(daemon, args.socket)
+        else:
+            serve_stdin(daemon)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
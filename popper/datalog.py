@@ -0,0 +1,141 @@
+# Tests rules over bk made only of ground facts without Prolog: each relation is held as a NumPy array with
+# one integer column per argument (constants are interned) and a rule is evaluated for all examples at once,
+# starting from a table of the examples and joining it with the relation of one body literal at a time.
+
+import clingo
+import numpy as np
+from itertools import chain
+from collections import defaultdict
+
+# the most rows of an intermediate table before giving the rule back to Prolog
+MAX_ROWS = 10000000
+
+def load_datalog(bk_file):
+    # the bk as relations, or None if it is not Datalog
+    with open(bk_file) as f:
+        bk = f.read()
+    # a rule calling a Prolog builtin, such as succ/2, grounds to nothing in clingo rather than failing, so
+    # calls to undefined predicates or operations mean the bk is not Datalog
+    codes = set()
+    solver = clingo.Control(logger=lambda code, _message: codes.add(code))
+    try:
+        solver.add('base', [], bk)
+        solver.ground([('base', [])])
+    except RuntimeError:
+        return None
+    if codes & {clingo.MessageCode.AtomUndefined, clingo.MessageCode.OperationUndefined}:
+        return None
+    facts = defaultdict(list)
+    for atom in solver.symbolic_atoms:
+        if not atom.is_fact:
+            return None
+        facts[(atom.symbol.name, len(atom.symbol.arguments))].append(atom.symbol.arguments)
+    return Datalog(facts)
+
+class Datalog:
+    def __init__(self, facts):
+        self.constants = {}
+        self.relations = {}
+        for (pred, arity), rows in facts.items():
+            rows = [[self.intern(x) for x in row] for row in rows]
+            self.relations[(pred, arity)] = np.array(rows, dtype=np.int64).reshape(len(rows), arity)
+        # for each head predicate, one row per example with its id and then its arguments
+        self.examples = {}
+
+    def intern(self, symbol):
+        return self.constants.setdefault(symbol, len(self.constants))
+
+    def set_examples(self, pos_index, neg_index):
+        rows = defaultdict(list)
+        for k, atom in chain(pos_index.items(), neg_index.items()):
+            try:
+                symbol = clingo.parse_term(atom)
+            except RuntimeError:
+                self.examples = None
+                return
+            rows[(symbol.name, len(symbol.arguments))].append([k] + [self.intern(x) for x in symbol.arguments])
+        self.examples = {head: np.array(xs, dtype=np.int64) for head, xs in rows.items()}
+
+    # the ids of the pos and neg examples the rule covers, or None if it calls a predicate that is not in the bk
+    def covered(self, rule):
+        head, body = rule
+        if self.examples == None:
+            return None
+        if any((literal.predicate, literal.arity) not in self.relations for literal in body):
+            return None
+        examples = self.examples.get((head.predicate, head.arity))
+        if examples is None:
+            return set(), set()
+
+        # the first column is the example id, which has no variable
+        table, names = select(examples, [None] + list(head.arguments))
+        remaining = list(body)
+        while remaining and len(table):
+            literal = next_literal(remaining, names, self.relations)
+            remaining.remove(literal)
+            rows, rows_names = select(self.relations[(literal.predicate, literal.arity)], literal.arguments)
+            table, names = join(table, names, rows, rows_names)
+            if table is None:
+                return None
+            # only keep the variables later literals use, as the others cannot change which examples are covered
+            needed = set(chain.from_iterable(literal.arguments for literal in remaining))
+            keep = [i for i, name in enumerate(names) if name == None or name in needed]
+            if len(keep) < len(names):
+                table = np.unique(table[:, keep], axis=0)
+                names = [names[i] for i in keep]
+
+        ids = np.unique(table[:, 0]).tolist()
+        return {i for i in ids if i > 0}, {i for i in ids if i < 0}
+
+def next_literal(literals, bound, relations):
+    # the literal with the most bound variables, so filters run first, and then the smallest relation
+    def literal_order(literal):
+        shared = len(set(literal.arguments).intersection(bound))
+        return -shared, len(relations[(literal.predicate, literal.arity)])
+    return min(literals, key=literal_order)
+
+def select(rows, args):
+    # the rows where repeated arguments agree, with one column per distinct argument
+    names = []
+    columns = []
+    mask = np.ones(len(rows), dtype=bool)
+    for i, arg in enumerate(args):
+        if arg in names:
+            mask &= rows[:, i] == rows[:, columns[names.index(arg)]]
+        else:
+            names.append(arg)
+            columns.append(i)
+    return rows[mask][:, columns], names
+
+def join(left, left_names, right, right_names):
+    # the joined table, or None if it would have more than MAX_ROWS rows
+    shared = [name for name in right_names if name in left_names]
+    new = [name for name in right_names if name not in left_names]
+    left_keys, right_keys = join_keys(left[:, [left_names.index(name) for name in shared]], right[:, [right_names.index(name) for name in shared]])
+
+    # a literal that binds no new variables only filters the table
+    if not new:
+        return left[np.isin(left_keys, right_keys)], left_names
+
+    order = np.argsort(right_keys, kind='stable')
+    sorted_keys = right_keys[order]
+    lo = np.searchsorted(sorted_keys, left_keys, side='left')
+    counts = np.searchsorted(sorted_keys, left_keys, side='right') - lo
+    total = int(counts.sum())
+    if total > MAX_ROWS:
+        return None, None
+    left_idx = np.repeat(np.arange(len(left)), counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    right_idx = order[np.repeat(lo, counts) + offsets]
+    new_columns = right[right_idx][:, [right_names.index(name) for name in new]]
+    return np.hstack([left[left_idx], new_columns]), left_names + new
+
+def join_keys(left, right):
+    # one integer per row so that rows are equal exactly when their keys are
+    if left.shape[1] == 0:
+        return np.zeros(len(left), dtype=np.int64), np.zeros(len(right), dtype=np.int64)
+    if left.shape[1] == 1:
+        return left[:, 0], right[:, 0]
+    _, keys = np.unique(np.vstack([left, right]), axis=0, return_inverse=True)
+    keys = keys.reshape(-1)
+    return keys[:len(left)], keys[len(left):]
@@ -1,12 +1,19 @@
+import re
 import clingo
 import clingo.script
-import pkg_resources
 from . core import Literal, ConstVar
+from . util import lp_path, DeadlineExceeded
 from collections import defaultdict
 clingo.script.enable_python()
 
 arg_lookup = {clingo.Number(i):chr(ord('A') + i) for i in range(100)}
 
+LIMIT_FACTS = re.compile(r'^\s*max_(body|clauses|vars)\(\s*\d+\s*\)\s*\.', re.MULTILINE)
+
+def nogood_to_string(nogood):
+    literals = (str(symbol) if sign else f'not {symbol}' for symbol, sign in nogood)
+    return ':- ' + ', '.join(literals) + '.'
+
 class Generator:
 
     def con_to_strings(self, con):
@@ -27,18 +34,55 @@ class Generator:
         self.settings = settings
         self.grounder = grounder
 
+        with open(lp_path('alan.pl')) as f:
+            self.alan = f.read()
+        self.bias = settings.bias.text
+
+        # nogoods learned so far, kept to carry them over to the next size layer
+        self.nogoods = []
+        # with size deepening, only programs with layer_min_size <= size <= layer_max_size
+        # are grounded at a time; layer_max_size is None once the bounds stop shrinking the grounding
+        self.layer_min_size = 2
+        self.layer_max_size = None
+        if settings.deepen:
+            self.layer_max_size = self.layer_min_size
+            if self.layer_is_saturated():
+                self.layer_max_size = None
+
+        self.solver = self.build_solver()
+
+    def layer_is_saturated(self):
+        k = self.layer_max_size
+        return k - 1 >= self.settings.max_body and k // 2 >= self.settings.max_rules
+
+    def build_solver(self):
+        max_rules = self.settings.max_rules
+        max_body = self.settings.max_body
+
         encoding = []
-        alan = pkg_resources.resource_string(__name__, "lp/alan.pl").decode()
-        encoding.append(alan)
-        with open(settings.bias_file) as f:
-            encoding.append(f.read())
-        encoding.append(f'max_clauses({settings.max_rules}).')
-        encoding.append(f'max_body({settings.max_body}).')
-        encoding.append(f'max_vars({settings.max_vars}).')
+        encoding.append(self.alan)
+        if self.settings.deepen:
+            # the layer sets its own limits
+            encoding.append(LIMIT_FACTS.sub('', self.bias))
+        else:
+            encoding.append(self.bias)
+
+        if self.layer_max_size is not None:
+            max_body = min(max_body, self.layer_max_size - 1)
+            max_rules = min(max_rules, self.layer_max_size // 2)
+            encoding.append(f':- size(N), N > {self.layer_max_size}.')
+        if self.layer_min_size > 2:
+            encoding.append(f':- size(N), N < {self.layer_min_size}.')
+
+        encoding.append(f'max_clauses({max_rules}).')
+        encoding.append(f'max_body({max_body}).')
+        encoding.append(f'max_vars({self.settings.max_vars}).')
 
         if self.settings.bkcons:
             encoding.append(self.settings.bkcons)
 
+        encoding.extend(nogood_to_string(nogood) for nogood in self.nogoods)
+
         encoding = '\n'.join(encoding)
 
         solver = clingo.Control(["--heuristic=Domain"])
@@ -46,8 +90,40 @@ class Generator:
         solver.configuration.solve.models = 0
         solver.add('base', [], encoding)
         solver.ground([('base', [])])
-        self.solver = solver
-
+        return solver
+
+    def next_layer(self):
+        if self.layer_max_size is None:
+            return False
+        self.layer_min_size = self.layer_max_size + 1
+        if self.layer_min_size > self.settings.max_literals:
+            return False
+        self.layer_max_size = self.layer_min_size
+        if self.layer_is_saturated():
+            self.layer_max_size = None
+        self.settings.logger.debug(f'Grounding programs of size {self.layer_min_size} to {self.layer_max_size or "max"}')
+        self.solver = self.build_solver()
+        return True
+
+    def solve(self, deadline=None):
+        while True:
+            with self.solver.solve(yield_ = True, async_ = True) as handle:
+                while True:
+                    handle.resume()
+                    if deadline and not handle.wait(deadline.remaining()):
+                        handle.cancel()
+                        raise DeadlineExceeded()
+                    model = handle.model()
+                    if model is None:
+                        break
+                    yield model
+            if not self.next_layer():
+                return
+
+    def add_nogood(self, model, nogood):
+        model.context.add_nogood(nogood)
+        if self.layer_max_size is not None:
+            self.nogoods.append(nogood)
 
     # TODO: COULD CACHE TUPLES OF ARGS FOR TINY OPTIMISATION
     def parse_model(self, model):
@@ -1,10 +1,11 @@
 import time
 import numbers
 from . combine import Combiner
-from . util import timeout, format_rule, rule_is_recursive, order_prog, prog_is_recursive, format_prog
+from . util import Deadline, DeadlineExceeded, format_rule, rule_is_recursive, order_prog, prog_is_recursive, format_prog
 from . tester import Tester
 from . generate import Generator, Grounder
 from . bkcons import deduce_bk_cons
+from . memory import MemoryManager
 from clingo import Function, Number, Tuple_
 
 
@@ -47,17 +48,60 @@ def constrain(settings, generator, cons, model):
             nogoods.append(nogood)
 
         for nogood in nogoods:
-            model.context.add_nogood(nogood)
-
-def popper(settings):
+            generator.add_nogood(model, nogood)
+
+def restart_combiner(settings, tester, combiner, deadline):
+    # the working set of examples has grown, so test the programs seen so far on it again
+    new_combiner = Combiner(settings, tester, deadline)
+    new_combiner.inconsistent = combiner.inconsistent
+    new_combiner.constraints = combiner.constraints
+    # the constraints refer to rules by id, so keep the ids
+    new_combiner.rulehash_to_id = combiner.rulehash_to_id
+    new_combiner.ruleid_to_rule = combiner.ruleid_to_rule
+    new_combiner.ruleid_to_size = combiner.ruleid_to_size
+    new_combiner.recursive_rules = combiner.recursive_rules
+    success_sets = {}
+    for prog in list(combiner.stored_progs()):
+        pos_covered, neg_covered, inconsistent = tester.test_prog(prog)
+        if inconsistent or len(pos_covered) == 0:
+            continue
+        new_combiner.update_prog_index(prog, pos_covered)
+        success_sets[(pos_covered, neg_covered)] = prog
+    return new_combiner, success_sets
+
+def register_structures(memory, tester, grounder, combiner, success_sets, seen_sets):
+    # the caches and the programs kept only for pruning can be dropped, as that only prunes less
+    memory.register('success sets', success_sets, 'clear')
+    for name, seen in seen_sets.items():
+        memory.register(name, seen, 'clear')
+    memory.register('program coverage', combiner.prog_coverage, 'spill')
+    memory.register('rules', combiner.ruleid_to_rule, 'spill')
+    memory.register('inconsistent programs', combiner.inconsistent)
+    memory.register('combiner constraints', combiner.constraints)
+    memory.register('grounder assignments', grounder.seen_assignments, 'clear')
+    memory.register('clingo atoms', cached_clingo_atoms, 'clear')
+    memory.register('consistency cache', tester.consistency_cache, 'clear')
+    memory.register('covers any cache', tester.covers_any_cache, 'clear')
+    memory.register('rule coverage', tester.rule_coverage)
+    memory.register('inconsistent cores', tester.inconsistent_cores)
+
+def popper(settings, tester=None, deadline=None):
+    memory = MemoryManager(settings)
+    try:
+        popper_aux(settings, tester, deadline, memory)
+    finally:
+        memory.report()
+
+def popper_aux(settings, tester, deadline, memory):
     if settings.bkcons:
         deduce_bk_cons(settings)
 
-    tester = Tester(settings)
+    if tester == None:
+        tester = Tester(settings)
+    tester.deadline = deadline
     grounder = Grounder()
-    combiner = Combiner(settings, tester)
+    combiner = Combiner(settings, tester, deadline)
     generator = Generator(settings, grounder)
-    pos = settings.pos
 
     success_sets = {}
     last_size = None
@@ -67,16 +111,19 @@ def popper(settings):
     seen_covers_only_one_spec = set()
     seen_incomplete_gen = set()
     seen_incomplete_spec = set()
+    seen_sets = {'seen covers only one gen': seen_covers_only_one_gen, 'seen covers only one spec': seen_covers_only_one_spec,
+                 'seen incomplete gen': seen_incomplete_gen, 'seen incomplete spec': seen_incomplete_spec}
+    register_structures(memory, tester, grounder, combiner, success_sets, seen_sets)
 
-    with (
-        generator.solver.solve(yield_ = True) as handle,
-        open(settings.tactic_file, 'w') as tactic_file
-    ):
-        handle = iter(handle)
+    with open(settings.tactic_file, 'w') as tactic_file:
+        handle = generator.solve(deadline)
 
         while True:
             model = None
 
+            if deadline:
+                deadline.check()
+
             with settings.stats.duration('generate'):
                 model = next(handle, None)
                 if model is None:
@@ -102,6 +149,7 @@ def popper(settings):
                     recall = tp / (tp + fn)
 
             settings.stats.total_programs += 1
+            memory.check()
             settings.logger.debug(f'Program {settings.stats.total_programs}:')
             for rule in order_prog(prog):
                 settings.logger.debug(format_rule(rule))
@@ -120,6 +168,8 @@ def popper(settings):
 
             add_spec = False
             add_gen = False
+            # whether the working set grew because the program misclassifies other examples
+            restarted = False
 
             # if inconsistent:
             #     # if inconsistent, prune generalisations
@@ -130,7 +180,7 @@ def popper(settings):
             #             if rule_is_recursive(rule):
             #                 continue
             #             subprog = frozenset([rule])
-            #             # TODO: ADD CACHING IF THIS STEP BECOMES TOO EXPENSIVE
+            #             # tester.is_inconsistent memoises its results per subprogram
             #             if tester.is_inconsistent(subprog):
             #                 new_cons.add(generator.build_generalisation_constraint(subprog))
             # else:
@@ -180,7 +230,7 @@ def popper(settings):
                         seen_covers_only_one_gen.add(prog)
                     if not add_spec:
                         seen_covers_only_one_spec.add(prog)
-                if len(pos_covered) != len(pos):
+                if len(pos_covered) != tester.num_pos:
                     if not add_gen:
                         seen_incomplete_gen.add(prog)
                     if not add_spec:
@@ -189,18 +239,18 @@ def popper(settings):
                 if combiner.solution_found:
                     for x in seen_covers_only_one_gen:
                         new_cons.add(generator.build_generalisation_constraint(x))
-                    seen_covers_only_one_gen = set()
+                    seen_covers_only_one_gen.clear()
                     for x in seen_covers_only_one_spec:
                         new_cons.add(generator.build_specialisation_constraint(x))
-                    seen_covers_only_one_spec = set()
+                    seen_covers_only_one_spec.clear()
 
                     if len(combiner.best_prog) <= 2:
                         for x in seen_incomplete_gen:
                             new_cons.add(generator.build_generalisation_constraint(x))
                         for x in seen_incomplete_spec:
                             new_cons.add(generator.build_specialisation_constraint(x))
-                        seen_incomplete_gen = set()
-                        seen_incomplete_spec = set()
+                        seen_incomplete_gen.clear()
+                        seen_incomplete_spec.clear()
 
 
             # if consistent, covers at least one example, and is not subsumed, try to find a solution
@@ -211,24 +261,56 @@ def popper(settings):
                 with settings.stats.duration('combine'):
                     new_solution_found = combiner.update_best_prog(prog, pos_covered)
 
+                # check the solution on all the examples and keep searching with the ones it gets wrong
+                if new_solution_found and settings.cegis:
+                    with settings.stats.duration('cegis'):
+                        if tester.add_counterexamples(combiner.best_prog):
+                            combiner, success_sets = restart_combiner(settings, tester, combiner, deadline)
+                            register_structures(memory, tester, grounder, combiner, success_sets, seen_sets)
+                            # the program is not a solution on all the examples, so neither bound the size by it nor stop
+                            # at it, but still apply the constraints of this program
+                            new_solution_found = False
+                            restarted = True
+
                 # if we find a new solution, update the maximum program size
                 if new_solution_found:
                     for i in range(combiner.max_size, settings.max_literals+1):
                         size_con = [(atom_to_symbol("size", (i,)), True)]
-                        model.context.add_nogood(size_con)
+                        generator.add_nogood(model, size_con)
                     settings.max_literals = combiner.max_size-1
 
             # if it covers all examples, stop
-            if not inconsistent and len(pos_covered) == len(pos):
+            if not inconsistent and not restarted and len(pos_covered) == tester.num_pos:
                 return
 
             if add_spec:
-                new_cons.add(generator.build_specialisation_constraint(prog, rule_ordering))
+                core = None
+                if settings.explain and len(pos_covered) == 0 and (not deadline or deadline.phase_remaining('explain') > 0):
+                    with settings.stats.duration('explain'):
+                        core = tester.explain_totally_incomplete(prog)
+                if core:
+                    new_cons.add(generator.build_specialisation_constraint(core))
+                else:
+                    new_cons.add(generator.build_specialisation_constraint(prog, rule_ordering))
             if add_gen:
                 new_cons.add(generator.build_generalisation_constraint(prog, rule_ordering))
 
             constrain(settings, generator, new_cons, model)
 
-def learn_solution(settings):
-    timeout(settings, popper, (settings,), timeout_duration=int(settings.timeout),)
+def learn_solution(settings, tester=None):
+    deadline = Deadline(settings.timeout, settings.stats, settings.phase_budgets)
+    if tester == None:
+        tester = Tester(settings)
+    try:
+        popper(settings, tester, deadline)
+    except DeadlineExceeded:
+        settings.logger.warn(f'TIMEOUT OF {int(settings.timeout)} SECONDS EXCEEDED')
+        settings.stats.timed_out = True
+    # the combiner stops by itself once the time is up
+    if deadline.expired():
+        settings.stats.timed_out = True
+    # the score so far is on the working set
+    if settings.cegis and settings.solution != None:
+        tester.deadline = None
+        settings.best_prog_score = tester.full_score(settings.solution)
     return settings.solution, settings.best_prog_score, settings.stats
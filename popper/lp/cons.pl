@@ -9,8 +9,9 @@ single_type(P):- body_pred(P,_), not type(P,_).
 single_type(P):- type(P,(T,T)).
 same_arity(P,Q):- body_pred(P,A), body_pred(Q,A).
 
+#program single.
+
 prop(singleton,P):- body_pred(P,_), #count{Vars : holds(P,Vars)} == 1.
-prop(unsat_pair,P,Q):- body_pred(Q,A), P > Q, same_type(P,Q), #count{Vars : holds(P,Vars), holds(Q,Vars)} == 0.
 
 prop(antitransitive,P):- antitransitive_type_check(P), body_pred(P,2), not antitransitive_aux(P).
 antitransitive_aux(P):- antitransitive_type_check(P), holds(P,(A,B)), holds(P,(B,C)), holds(P,(A,C)).
@@ -175,6 +176,10 @@ symmetric_xab_aux(P):-
 
 
 
+#program pair.
+
+prop(unsat_pair,P,Q):- body_pred(Q,A), P > Q, same_type(P,Q), #count{Vars : holds(P,Vars), holds(Q,Vars)} == 0.
+
 prop(chain,(P,Q)):-
     type(P,(_,Ta)),
     type(Q,(Ta,_)),
@@ -204,6 +209,8 @@ prop(postcon,(P,Q)):-
     body_pred(Q,1),
     #count{B : holds(P,(_,B)), holds(Q,(B,))} == 0.
 
+#program triple.
+
 prop(pre_postcon,(P,Q,R)):-
     type(P,(Ta,)),
     type(Q,(Ta,Tb)),
@@ -223,6 +230,8 @@ pre_postcon_sat((P,Q,R)):-
     holds(Q,(A,B)),
     holds(R,(B,)).
 
+#program pair.
+
 prop(pab_qac,(P,Q)):-
     type(P,(Ta,_)),
     type(Q,(Ta,_)),
@@ -28,6 +28,47 @@ assert_neg_aux([H|T],I1):-
     I2 is I1-1,
     assert_neg_aux(T,I2).
 
+%%%%%%%%%% EXAMPLE CACHING %%%%%%%%%%
+
+%% writes the examples and their indices as plain facts and compiles them to a .qlf
+%% the compiled clauses are loaded into a scratch module so they do not clash with the
+%% examples already loaded in user
+compile_example_cache(File):-
+    setup_call_cleanup(
+        open(File, write, Stream),
+        write_example_facts(Stream),
+        close(Stream)),
+    popper_cache:qcompile(File).
+
+write_example_facts(Stream):-
+    format(Stream, ':- dynamic pos_index/2.~n:- dynamic neg_index/2.~n', []),
+    format(Stream, ':- discontiguous pos/1.~n:- discontiguous neg/1.~n~n', []),
+    forall(pos(X), portray_clause(Stream, pos(X))),
+    forall((current_predicate(neg/1), neg(X)), portray_clause(Stream, neg(X))),
+    forall((current_predicate(pos_index/2), pos_index(I,X)), portray_clause(Stream, pos_index(I,X))),
+    forall((current_predicate(neg_index/2), neg_index(I,X)), portray_clause(Stream, neg_index(I,X))).
+
+%%%%%%%%%% DEADLINE %%%%%%%%%%
+
+%% the deadline of the search runs Goal under call_with_time_limit/2 as well, which throws the same
+%% time_limit_exceeded as the limit on each example, so a catch of that limit rethrows it once the
+%% deadline has passed rather than treating it as the example timing out
+with_deadline(T, Goal):-
+    get_time(Now),
+    End is Now + T,
+    setup_call_cleanup(
+        nb_setval(popper_deadline, End),
+        call_with_time_limit(T, Goal),
+        nb_setval(popper_deadline, none)).
+
+check_deadline:-
+    nb_current(popper_deadline, End),
+    number(End),
+    get_time(Now),
+    Now >= End,!,
+    throw(time_limit_exceeded).
+check_deadline.
+
 %%%%%%%%%% EXAMPLE TESTING %%%%%%%%%%
 
 ex_index(ID,Atom):-
@@ -37,10 +78,26 @@ ex_index(ID,Atom):-
     current_predicate(neg_index/2),
     neg_index(ID,Atom).
 
+%% with an inference limit, each example gets at most Limit inferences and all examples of
+%% a program share the budget in popper_budget; examples that are cut off count as not covered
+test_ex(Atom):-
+    current_predicate(inference_limit/1),!,
+    inference_limit(Limit),
+    nb_getval(popper_budget, Budget),
+    (Budget =< 0 -> flag(popper_cutoffs, N, N+1), fail ; true),
+    L is min(Limit, Budget),
+    statistics(inferences, I0),
+    (call_with_inference_limit(Atom, L, Result) -> true ; Result = false),
+    statistics(inferences, I1),
+    Budget1 is Budget - (I1 - I0),
+    nb_setval(popper_budget, Budget1),
+    (Result == inference_limit_exceeded -> flag(popper_cutoffs, M, M+1), fail ; true),
+    Result \== false.
+
 test_ex(Atom):-
     current_predicate(timeout/1),!,
     timeout(T),
-    catch(call_with_time_limit(T, call(Atom)),time_limit_exceeded,false),!.
+    catch(call_with_time_limit(T, call(Atom)),time_limit_exceeded,(check_deadline, false)),!.
 
 test_ex(Atom):-
     call(Atom),!.
@@ -51,10 +108,99 @@ pos_covered(Xs):-
 neg_covered(Xs):-
     findall(ID, (neg_index(ID,Atom),test_ex(Atom)), Xs).
 
+%% the full example set when learning from a working set of examples
+all_pos_covered(Xs):-
+    findall(ID, (all_pos_index(ID,Atom),test_ex(Atom)), Xs).
+
+all_neg_covered(Xs):-
+    findall(ID, (all_neg_index(ID,Atom),test_ex(Atom)), Xs).
+
 inconsistent:-
     neg_index(_,Atom),
     test_ex(Atom),!.
 
+covers_any_pos:-
+    pos_index(_,Atom),
+    test_ex(Atom),!.
+
+first_neg_covered(ID):-
+    neg_index(ID,Atom),
+    test_ex(Atom),!.
+
+%% reasserts the examples of Index (pos_index or neg_index) in the order of Ids, so that the
+%% queries that stop at the first covered example try the most often covered ones first
+reorder_examples(Index, Ids):-
+    findall(Fact, (member(ID, Ids), Fact =.. [Index, ID, _], call(Fact)), Facts),
+    Pattern =.. [Index, _, _],
+    retractall(Pattern),
+    forall(member(Fact, Facts), assertz(Fact)).
+
+%%%%%%%%%% PREFIX BINDINGS %%%%%%%%%%
+
+%% asserts Row for every solution of Goal, failing and retracting the rows if there are more than Max or
+%% finding them takes more than Budget, either inferences(N) or seconds(T)
+store_bindings(Row, Goal, Max, Budget):-
+    flag(popper_rows, _, 0),
+    (   catch(call_within(Budget, forall(Goal, (flag(popper_rows, N, N+1), N < Max, assertz(Row)))), time_limit_exceeded, (check_deadline, fail))
+    ->  true
+    ;   retractall(Row), fail
+    ).
+
+call_within(inferences(Limit), Goal):-
+    call_with_inference_limit(Goal, Limit, Result),
+    Result \== inference_limit_exceeded.
+call_within(seconds(T), Goal):-
+    call_with_time_limit(T, Goal).
+
+%%%%%%%%%% PREDICATE STATISTICS %%%%%%%%%%
+
+:- dynamic popper_pool/2.
+
+%% values of each type to call the body predicates on, seeded with the arguments of the examples
+seed_pool(Type, Pred, Arity, I, Max):-
+    functor(Atom, Pred, Arity),
+    forall(limit(Max, (ex_index(_, Atom), arg(I, Atom, V))), add_pool(Type, V, Max)).
+
+add_pool(Type, V, _):-
+    popper_pool(Type, X), X == V, !.
+add_pool(Type, _, Max):-
+    aggregate_all(count, popper_pool(Type, _), N), N >= Max, !.
+add_pool(Type, V, _):-
+    assertz(popper_pool(Type, V)).
+
+%% calls Goal on Samples random bindings of Inputs (a list of Type-Var pairs) from the pools, adding
+%% the values of Outputs to the pools, and counts the calls made and their solutions and inferences
+pred_stats(Goal, Inputs, Outputs, Samples, Limit, Max, Calls, Sols, Inferences):-
+    flag(popper_calls, _, 0),
+    flag(popper_sols, _, 0),
+    flag(popper_inferences, _, 0),
+    forall(between(1, Samples, _), \+ \+ (bind_inputs(Inputs) -> sample_goal(Goal, Outputs, Limit, Max) ; true)),
+    flag(popper_calls, Calls, Calls),
+    flag(popper_sols, Sols, Sols),
+    flag(popper_inferences, Inferences, Inferences).
+
+bind_inputs([]).
+bind_inputs([Type-V|T]):-
+    findall(X, popper_pool(Type, X), Xs),
+    random_member(V, Xs),
+    bind_inputs(T).
+
+%% the bk may raise errors on values it does not expect, which count as no solutions
+sample_goal(Goal, Outputs, Limit, Max):-
+    flag(popper_sample_sols, _, 0),
+    statistics(inferences, I0),
+    catch(call_with_inference_limit(forall(Goal, (flag(popper_sample_sols, N, N+1), add_outputs(Outputs, Max))), Limit, _), _, check_deadline),
+    statistics(inferences, I1),
+    flag(popper_sample_sols, S, S),
+    flag(popper_calls, C, C+1),
+    flag(popper_sols, S0, S0+S),
+    flag(popper_inferences, F, F+I1-I0).
+
+add_outputs([], _).
+add_outputs([Type-V|T], Max):-
+    (ground(V) -> add_pool(Type, V, Max) ; true),
+    add_outputs(T, Max).
+
 %% ========== FUNCTIONAL CHECKS ==========
 non_functional:-
     pos(Atom),
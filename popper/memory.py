@@ -0,0 +1,154 @@
+# Keeps the search within a memory budget (--memory-budget MB). The search registers the structures that grow
+# with the number of programs; once the RSS of the process passes the budget, the caches among them are
+# cleared and the stores that must be kept are spilled to a temporary sqlite database on disk.
+
+import os
+import sys
+import pickle
+import resource
+import itertools
+from collections.abc import MutableMapping
+
+# how many calls to MemoryManager.check between reads of the RSS
+CHECK_INTERVAL = 100
+# how many entries of a structure to measure to estimate the size of all of them
+SIZE_SAMPLE = 100
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        # the peak RSS, in KB on Linux and in bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+def approx_mb(obj):
+    # the container and a sample of its entries, scaled up to all of them
+    if isinstance(obj, SpillDict):
+        obj = obj.hot
+    if isinstance(obj, dict):
+        sample = [sys.getsizeof(k) + sys.getsizeof(v) for k, v in itertools.islice(obj.items(), SIZE_SAMPLE)]
+    else:
+        sample = [sys.getsizeof(x) for x in itertools.islice(obj, SIZE_SAMPLE)]
+    per_entry = sum(sample) / len(sample) if sample else 0
+    return (sys.getsizeof(obj) + per_entry * len(obj)) / 2**20
+
+class SpillDict(MutableMapping):
+    # a dict whose entries can be moved to disk, where they are read back from when used
+    # keys must pickle to the same bytes every time, such as ints, strings, and tuples of them
+    # the keys on disk are also kept in memory, so only reading or deleting them goes to disk, and
+    # iterating over the entries reads every spilled entry back
+    def __init__(self):
+        self.hot = {}
+        self.db = None
+        self.cold = set()
+
+    def __getitem__(self, key):
+        if key in self.hot:
+            return self.hot[key]
+        if key in self.cold:
+            row = self.db.execute('SELECT v FROM kv WHERE k = ?', (pickle.dumps(key),)).fetchone()
+            if row != None:
+                return pickle.loads(row[0])
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self.delete_cold(key)
+        self.hot[key] = value
+
+    def __delitem__(self, key):
+        if key in self.hot:
+            del self.hot[key]
+        elif not self.delete_cold(key):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.hot or key in self.cold
+
+    def __iter__(self):
+        for key, _value in self.items():
+            yield key
+
+    def items(self):
+        yield from list(self.hot.items())
+        if self.db != None:
+            for k, v in self.db.execute('SELECT k, v FROM kv'):
+                yield pickle.loads(k), pickle.loads(v)
+
+    def __len__(self):
+        return len(self.hot) + len(self.cold)
+
+    def delete_cold(self, key):
+        if key not in self.cold:
+            return False
+        self.db.execute('DELETE FROM kv WHERE k = ?', (pickle.dumps(key),))
+        self.cold.remove(key)
+        return True
+
+    def spill(self):
+        if self.db == None:
+            # only imported once needed to keep start up fast
+            import sqlite3
+            # an empty name is a private database on disk, deleted when closed
+            self.db = sqlite3.connect('')
+            self.db.execute('CREATE TABLE kv (k BLOB PRIMARY KEY, v BLOB)')
+        rows = [(pickle.dumps(k), pickle.dumps(v)) for k, v in self.hot.items()]
+        self.db.executemany('INSERT OR REPLACE INTO kv VALUES (?, ?)', rows)
+        self.cold.update(self.hot)
+        self.hot = {}
+        return len(rows)
+
+    def clear(self):
+        self.hot = {}
+        if self.db != None:
+            self.db.close()
+            self.db = None
+        self.cold = set()
+
+class MemoryManager:
+    def __init__(self, settings):
+        self.budget = settings.memory_budget
+        self.stats = settings.stats
+        self.logger = settings.logger
+        # maps a name to a structure and what to do with it when over budget: 'clear' for caches,
+        # 'spill' for a SpillDict, or None to only report its size
+        self.structures = {}
+        self.calls = 0
+        # freed memory is mostly kept by the process for reuse rather than given back, so the RSS
+        # has to grow past what it was at the last clean up before cleaning up again
+        self.last_cleanup_rss = 0
+
+    def register(self, name, obj, action=None):
+        self.structures[name] = obj, action
+
+    def check(self):
+        self.calls += 1
+        if self.calls % CHECK_INTERVAL:
+            return
+        rss = rss_mb()
+        self.stats.peak_rss_mb = max(self.stats.peak_rss_mb, rss)
+        if self.budget and rss > self.budget and rss > self.last_cleanup_rss:
+            self.free(rss)
+            self.last_cleanup_rss = rss
+
+    def free(self, rss):
+        cleared = 0
+        spilled = 0
+        for obj, action in self.structures.values():
+            if action == 'clear':
+                cleared += len(obj)
+                obj.clear()
+            elif action == 'spill':
+                spilled += obj.spill()
+        self.stats.memory_cleanups += 1
+        self.stats.memory_cleared += cleared
+        self.stats.memory_spilled += spilled
+        self.logger.info(f'RSS of {rss:0.0f}MB is over the memory budget: cleared {cleared} cache entries and spilled {spilled} entries to disk')
+
+    def report(self):
+        rss = rss_mb()
+        self.stats.rss_mb = rss
+        self.stats.peak_rss_mb = max(self.stats.peak_rss_mb, rss)
+        self.stats.memory = {name: (len(obj), approx_mb(obj)) for name, (obj, _action) in self.structures.items()}
@@ -0,0 +1,23 @@
+import json
+
+# Orders body literals by the statistics of their predicates: the average number of solutions and
+# inferences of a call with the inputs bound, sampled from the bk (see Tester.sample_pred_costs).
+# Among the literals whose inputs are bound, the one with the lowest rank (solutions - 1) / inferences
+# goes first, so cheap filters run before expensive generators.
+
+def literal_rank(predicate, is_check, costs):
+    if not costs or predicate not in costs:
+        return 0
+    solutions, inferences = costs[predicate]
+    # with its outputs already bound a literal can only filter
+    if is_check:
+        solutions = min(solutions, 1)
+    return (solutions - 1) / max(inferences, 1)
+
+def save_costs(path, costs):
+    with open(path, 'w') as f:
+        json.dump(costs, f, indent=1, sort_keys=True)
+
+def load_costs(path):
+    with open(path) as f:
+        return {predicate: tuple(cost) for predicate, cost in json.load(f).items()}
@@ -1,19 +1,48 @@
 import os
-import numpy as np
-import pkg_resources
-from pyswip import Prolog
+import random
+import itertools
+from collections import OrderedDict, Counter
 from contextlib import contextmanager
-from . util import format_rule, order_rule, order_prog, prog_is_recursive, format_prog
+from . core import Literal
+from . planner import save_costs, load_costs
+from . util import format_rule, format_literal, order_rule, order_body, order_prog, prog_is_recursive, rule_is_recursive, format_prog, file_hash, rule_key, prog_key, lp_path, prog_size, DeadlineExceeded, TOP_NEGS
+
+CACHE_DIR = '.popper_cache'
+# calls per predicate and rounds to sample the bk with to order body literals, the most inferences
+# per call, and the most values kept of each type
+PLAN_SAMPLES = 20
+PLAN_ROUNDS = 2
+PLAN_INFERENCES = 100000
+POOL_SIZE = 50
+# how many tested programs between reorderings of the examples
+REORDER_INTERVAL = 1000
 
 class Tester():
 
     def query(self, query, key):
-        result = next(self.prolog.query(query))[key]
+        return set(self.query_list(query, key))
+
+    def query_list(self, query, key):
+        result = next(self.limited_query(query))[key]
         result = map(lambda s: s.replace("\'", "") if type(s) == str else s, result)
-        return set(result)
+        return list(result)
 
     def bool_query(self, query,):
-        return len(list(self.prolog.query(query))) > 0
+        return len(list(self.limited_query(query))) > 0
+
+    def limited_query(self, query):
+        if self.deadline == None:
+            yield from self.prolog.query(query)
+            return
+        remaining = self.deadline.remaining()
+        if remaining < 0.001:
+            raise DeadlineExceeded()
+        try:
+            yield from self.prolog.query(f'with_deadline({remaining:.3f},({query}))')
+        except Exception as e:
+            if 'time_limit_exceeded' in str(e):
+                raise DeadlineExceeded() from e
+            raise
 
     # TODO: COULD PUSH TO CLINGO TO SAVE PROLOG FROM HAVING TO INDEX STUFF
     def get_examples(self):
@@ -30,30 +59,119 @@ class Tester():
 
         if self.settings.max_examples < len(pos):
             self.settings.stats.logger.info(f'Sampling {self.settings.max_examples} pos examples')
-            pos = np.random.choice(list(pos), self.settings.max_examples)
+            pos = random.sample(list(pos), self.settings.max_examples)
+            self.sampled = True
         if self.settings.max_examples < len(neg):
             self.settings.stats.logger.info(f'Sampling {self.settings.max_examples} neg examples')
-            neg = np.random.choice(list(neg), self.settings.max_examples)
+            neg = random.sample(list(neg), self.settings.max_examples)
+            self.sampled = True
 
         return pos, neg
 
     def __init__(self, settings):
+        # pyswip starts SWI-Prolog when imported, so only do so once a tester is needed
+        from pyswip import Prolog
         self.settings = settings
         self.prolog = Prolog()
+        self.sampled = False
+        self.deadline = None
+        # maps a rule to the id of the r_<id> predicate holding its compiled body, in LRU order
+        self.rule_cache = OrderedDict()
+        self.next_rule_id = 1
+        self.tabled = set()
+        # consistency of already tested programs and the smallest inconsistent programs found
+        self.consistency_cache = {}
+        self.inconsistent_cores = []
+        # whether already tested programs cover at least one positive example
+        self.covers_any_cache = {}
+        # the examples each rule covers as bitsets, where example k (or -k if negative) is bit k-1, in LRU order
+        self.rule_coverage = OrderedDict()
+        # maps a rule to the id of the p_<id> predicate holding the bindings of its body for each
+        # example it covers, its variables, and the size of the bindings in bytes, in LRU order
+        self.prefix_tables = OrderedDict()
+        self.prefix_bytes = 0
+        self.next_prefix_id = 1
+        # the average solutions and inferences of each body predicate to order body literals by
+        self.pred_costs = None
+        # the bk as relations to test rules on without Prolog, if it is Datalog
+        self.datalog = None
+        # how many tested programs cover each example, to put the examples that most often decide
+        # consistency (or coverage) first in neg_index (or pos_index)
+        self.pos_hits = Counter()
+        self.neg_hits = Counter()
+        self.example_order = {}
+        self.top_negs = set()
+        self.recorded = 0
 
         bk_pl_path = self.settings.bk_file
         exs_pl_path = self.settings.ex_file
-        test_pl_path = pkg_resources.resource_filename(__name__, "lp/test.pl")
+        test_pl_path = lp_path('test.pl')
+
+        cache_path = None
+        # the working set of examples changes during the search, so there is nothing fixed to cache
+        if self.settings.qlf_cache and not self.settings.cegis:
+            cache_path = self.example_cache_path(exs_pl_path, test_pl_path)
+
+        if cache_path and os.path.isfile(cache_path + '.qlf'):
+            for x in [bk_pl_path, test_pl_path]:
+                self.consult(x)
+            self.load_example_cache(cache_path + '.qlf')
+        else:
+            for x in [exs_pl_path, bk_pl_path, test_pl_path]:
+                self.consult(x)
+            self.index_examples()
+            # a sampled example set is different on every run so there is no point caching it
+            if cache_path and not self.sampled:
+                self.write_example_cache(cache_path + '.pl')
+
+        self.settings.pos = frozenset(self.pos_index.values())
+        self.settings.neg = frozenset(self.neg_index.values())
+
+        if self.settings.eval_inferences:
+            self.prolog.assertz(f'inference_limit({self.settings.eval_inferences})')
+        elif self.settings.recursion_enabled:
+            self.prolog.assertz(f'timeout({self.settings.eval_timeout})')
+
+        if self.settings.order_by_cost:
+            self.pred_costs = self.load_pred_costs()
+
+        if self.settings.datalog:
+            # imported here as it needs numpy
+            from . datalog import load_datalog
+            with self.settings.stats.duration('load datalog'):
+                self.datalog = load_datalog(bk_pl_path)
+            if self.datalog == None:
+                self.settings.stats.logger.info('The bk is not Datalog, so rules are tested with Prolog')
+            else:
+                self.datalog.set_examples(self.pos_index, self.neg_index)
+
+
+    def reuse(self, settings):
+        # learn another task over the same bk and examples without loading them again
+        self.settings = settings
+        if self.settings.cegis:
+            # the working set grew with the counterexamples of the last task, so start from a new one
+            self.bool_query('retractall(pos_index(_,_)),retractall(neg_index(_,_))')
+            self.sample_working_set()
+            return
+        self.settings.pos = frozenset(self.pos_index.values())
+        self.settings.neg = frozenset(self.neg_index.values())
 
-        for x in [exs_pl_path, bk_pl_path, test_pl_path]:
-            if os.name == 'nt': # if on Windows, SWI requires escaped directory separators
-                x = x.replace('\\', '\\\\')
-            self.prolog.consult(x)
+    def consult(self, path):
+        if os.name == 'nt': # if on Windows, SWI requires escaped directory separators
+            path = path.replace('\\', '\\\\')
+        self.prolog.consult(path)
 
+    def index_examples(self):
         self.pos_index = {}
         self.neg_index = {}
 
         pos, neg = self.get_examples()
+
+        if self.settings.cegis:
+            self.index_working_set(pos, neg)
+            return
+
         self.num_pos = len(pos)
         self.num_neg = len(neg)
 
@@ -67,32 +185,326 @@ class Tester():
             self.prolog.assertz(f'neg_index({k},{atom})')
             self.neg_index[k] = atom
 
+    # learn from a small working set of examples and only test solutions on all of them
+    def index_working_set(self, pos, neg):
+        self.all_pos_index = {i+1:atom for i, atom in enumerate(pos)}
+        self.all_neg_index = {-(i+1):atom for i, atom in enumerate(neg)}
+        self.bool_query('dynamic([pos_index/2, neg_index/2, all_pos_index/2, all_neg_index/2])')
+        for k, atom in self.all_pos_index.items():
+            self.prolog.assertz(f'all_pos_index({k},{atom})')
+        for k, atom in self.all_neg_index.items():
+            self.prolog.assertz(f'all_neg_index({k},{atom})')
+        self.sample_working_set()
+
+    def sample_working_set(self):
+        self.pos_index = {}
+        self.neg_index = {}
+        n = self.settings.cegis
+        pos_ids = random.sample(list(self.all_pos_index), min(n, len(self.all_pos_index)))
+        neg_ids = random.sample(list(self.all_neg_index), min(n, len(self.all_neg_index)))
+        self.settings.stats.logger.info(f'Working set: {len(pos_ids)} pos and {len(neg_ids)} neg examples')
+        self.num_pos = 0
+        self.num_neg = 0
+        self.add_examples(pos_ids + neg_ids)
+
+    def add_examples(self, ids):
+        for k in ids:
+            if k > 0:
+                atom = self.all_pos_index[k]
+                self.prolog.assertz(f'pos_index({k},{atom})')
+                self.pos_index[k] = atom
+            else:
+                atom = self.all_neg_index[k]
+                self.prolog.assertz(f'neg_index({k},{atom})')
+                self.neg_index[k] = atom
+        self.num_pos = len(self.pos_index)
+        self.num_neg = len(self.neg_index)
         self.settings.pos = frozenset(self.pos_index.values())
         self.settings.neg = frozenset(self.neg_index.values())
+        # a program may cover the new examples, but an inconsistent program stays inconsistent
+        self.consistency_cache = {}
+        self.covers_any_cache = {}
+        self.rule_coverage = OrderedDict()
+        self.clear_prefix_tables()
+        if self.datalog != None:
+            self.datalog.set_examples(self.pos_index, self.neg_index)
 
-        if self.settings.recursion_enabled:
-            self.prolog.assertz(f'timeout({self.settings.eval_timeout})')
+    def misclassified(self, prog):
+        # the examples outside the working set that the program gets wrong
+        with self.using(prog):
+            pos_covered = set(self.query('all_pos_covered(Xs)', 'Xs'))
+            neg_covered = set(self.query('all_neg_covered(Xs)', 'Xs'))
+        fn = set(self.all_pos_index) - pos_covered
+        return fn | neg_covered
+
+    def add_counterexamples(self, prog):
+        wrong = self.misclassified(prog)
+        if not wrong:
+            return False
+        wrong = random.sample(sorted(wrong), min(self.settings.cegis, len(wrong)))
+        self.settings.stats.cegis_rounds += 1
+        self.settings.stats.cegis_examples += len(wrong)
+        self.settings.stats.logger.info(f'Solution misclassifies examples outside the working set, adding {len(wrong)} of them')
+        self.add_examples(wrong)
+        return True
+
+    def full_score(self, prog):
+        with self.using(prog):
+            tp = len(self.query('all_pos_covered(Xs)', 'Xs'))
+            fp = len(self.query('all_neg_covered(Xs)', 'Xs'))
+        fn = len(self.all_pos_index) - tp
+        tn = len(self.all_neg_index) - fp
+        return tp, fn, tn, fp, prog_size(prog)
+
+    def example_cache_path(self, exs_pl_path, test_pl_path):
+        cache_dir = os.path.join(os.path.dirname(exs_pl_path), CACHE_DIR)
+        os.makedirs(cache_dir, exist_ok=True)
+        k = file_hash(exs_pl_path, test_pl_path, extra=str(self.settings.max_examples))
+        return os.path.join(cache_dir, f'exs-{k}')
+
+    def pred_costs_path(self):
+        cache_dir = os.path.join(os.path.dirname(self.settings.bk_file), CACHE_DIR)
+        os.makedirs(cache_dir, exist_ok=True)
+        k = file_hash(self.settings.bk_file, self.settings.ex_file, self.settings.bias_file, lp_path('test.pl'))
+        return os.path.join(cache_dir, f'costs-{k}.json')
+
+    def load_pred_costs(self):
+        path = self.pred_costs_path()
+        if os.path.isfile(path):
+            return load_costs(path)
+        with self.settings.stats.duration('sample bk'):
+            costs = self.sample_pred_costs()
+        save_costs(path, costs)
+        self.settings.stats.logger.info(f'Saved predicate costs to {path}')
+        return costs
+
+    def sample_pred_costs(self):
+        bias = self.settings.bias
+        self.bool_query('retractall(popper_pool(_,_))')
+        for pred, arity in bias.head_preds:
+            for modes in arg_modes(bias, pred, arity):
+                for i, (_direction, arg_type) in enumerate(modes):
+                    self.bool_query(f'seed_pool({arg_type},{pred},{arity},{i+1},{POOL_SIZE})')
+
+        totals = {}
+        # the outputs of one predicate are the inputs of another, so each round reaches more values
+        for _ in range(PLAN_ROUNDS):
+            for pred, arity in sorted(bias.body_preds):
+                args = [f'V{i}' for i in range(arity)]
+                for modes in arg_modes(bias, pred, arity):
+                    inputs = ','.join(f'{arg_type}-{arg}' for (direction, arg_type), arg in zip(modes, args) if direction == 'in')
+                    outputs = ','.join(f'{arg_type}-{arg}' for (direction, arg_type), arg in zip(modes, args) if direction != 'in')
+                    samples = PLAN_SAMPLES if inputs else 1
+                    query = f'pred_stats({pred}({",".join(args)}),[{inputs}],[{outputs}],{samples},{PLAN_INFERENCES},{POOL_SIZE},Calls,Sols,Inferences)'
+                    result = next(self.prolog.query(query))
+                    calls, sols, inferences = totals.get(pred, (0, 0, 0))
+                    totals[pred] = calls + result['Calls'], sols + result['Sols'], inferences + result['Inferences']
 
+        costs = {pred: (sols / calls, inferences / calls) for pred, (calls, sols, inferences) in totals.items() if calls}
+        for pred, (sols, inferences) in sorted(costs.items()):
+            self.settings.stats.logger.debug(f'{pred}: {sols:0.2f} solutions \t {inferences:0.1f} inferences per call')
+        return costs
+
+    def write_example_cache(self, path):
+        if os.name == 'nt':
+            path = path.replace('\\', '\\\\')
+        with self.settings.stats.duration('compile examples'):
+            self.bool_query(f"compile_example_cache('{path}')")
+
+    def load_example_cache(self, path):
+        if os.name == 'nt':
+            path = path.replace('\\', '\\\\')
+        with self.settings.stats.duration('load examples'):
+            self.bool_query(f"load_files('{path}',[])")
+            pos = self.query_list('findall(X,pos_index(_,X),Xs)', 'Xs')
+            neg = self.query_list('findall(X,neg_index(_,X),Xs)', 'Xs')
+        self.settings.stats.logger.info(f'Loaded examples from {path}')
+        self.pos_index = {i+1:atom for i, atom in enumerate(pos)}
+        self.neg_index = {-(i+1):atom for i, atom in enumerate(neg)}
+        self.num_pos = len(pos)
+        self.num_neg = len(neg)
 
     # neg_covered = frozenset(next(self.prolog.query('neg_covered(Xs)'))['Xs'])
     # neg_covered = frozenset(self.neg_index[i] for i in neg_covered)
 
     def test_prog(self, prog):
+        # with a shared inference budget the coverage of a rule depends on the rest of the program
+        if self.settings.eval_inferences == None and is_decomposable(prog):
+            return self.test_rules(prog)
         with self.using(prog):
-            pos_covered = frozenset(self.query('pos_covered(Xs)', 'Xs'))
-            pos_covered = frozenset(self.pos_index[i] for i in pos_covered)
-            neg_covered = frozenset(next(self.prolog.query('neg_covered(Xs)'))['Xs'])
-            neg_covered = frozenset(self.neg_index[i] for i in neg_covered)
-            inconsistent = False
-            if len(self.neg_index):
-                inconsistent = len(list(self.prolog.query("inconsistent"))) > 0
+            pos_ids = self.query('pos_covered(Xs)', 'Xs')
+            neg_ids = self.query('neg_covered(Xs)', 'Xs')
+        self.record_coverage(pos_ids, neg_ids)
+        pos_covered = frozenset(self.pos_index[i] for i in pos_ids)
+        neg_covered = frozenset(self.neg_index[i] for i in neg_ids)
+        # the negatives covered are already known, so there is no need to query consistency
+        inconsistent = len(neg_ids) > 0
+        k = prog_key(prog)
+        self.consistency_cache[k] = inconsistent
+        self.covers_any_cache[k] = len(pos_covered) > 0
         return pos_covered, neg_covered, inconsistent
 
+    def test_rules(self, prog):
+        pos_bits = 0
+        neg_bits = 0
+        cached = True
+        for rule in prog:
+            k = rule_key(rule)
+            if k in self.rule_coverage:
+                self.rule_coverage.move_to_end(k)
+            else:
+                cached = False
+                pos_ids, neg_ids = self.rule_covered(rule)
+                self.rule_coverage[k] = ids_to_bits(pos_ids), ids_to_bits(-i for i in neg_ids)
+                if len(self.rule_coverage) > self.settings.max_cached_rules:
+                    self.rule_coverage.popitem(last=False)
+            rule_pos_bits, rule_neg_bits = self.rule_coverage[k]
+            pos_bits |= rule_pos_bits
+            neg_bits |= rule_neg_bits
+        if cached:
+            self.settings.stats.coverage_cache_hits += 1
+
+        pos_ids = bits_to_ids(pos_bits)
+        neg_ids = [-i for i in bits_to_ids(neg_bits)]
+        self.record_coverage(pos_ids, neg_ids)
+        pos_covered = frozenset(self.pos_index[i] for i in pos_ids)
+        neg_covered = frozenset(self.neg_index[i] for i in neg_ids)
+        inconsistent = neg_bits != 0
+        k = prog_key(prog)
+        self.consistency_cache[k] = inconsistent
+        self.covers_any_cache[k] = pos_bits != 0
+        return pos_covered, neg_covered, inconsistent
+
+    def rule_covered(self, rule):
+        if self.datalog != None:
+            covered = self.datalog.covered(rule)
+            if covered != None:
+                self.settings.stats.datalog_rules += 1
+                return covered
+
+        if not self.settings.prefix_cache_mb:
+            with self.using([rule]):
+                return self.query('pos_covered(Xs)', 'Xs'), self.query('neg_covered(Xs)', 'Xs')
+
+        head, body = rule
+        prefix = self.find_prefix(rule)
+        if prefix == None:
+            head_atom = format_literal(head)
+            goal = body_goal(order_rule(rule, self.pred_costs)[1])
+        else:
+            prefix_body, (table_id, table_vars, _size) = prefix
+            self.settings.stats.prefix_cache_hits += 1
+            head_atom = '_'
+            suffix = set(body).difference(prefix_body)
+            goal = body_goal([table_literal(table_id, table_vars)] + list(order_body(rule, suffix, set(table_vars), self.pred_costs)))
+
+        pos_ids = self.query(f'findall(ID,(pos_index(ID,{head_atom}),test_ex(({goal}))),Xs)', 'Xs')
+        neg_ids = self.query(f'findall(ID,(neg_index(ID,{head_atom}),test_ex(({goal}))),Xs)', 'Xs')
+
+        # only a rule that covers both pos and neg examples is specialised by later rules
+        if pos_ids and neg_ids and len(body) < self.settings.max_body:
+            if prefix == None:
+                goal = f'ex_index(ID,{head_atom}),{goal}'
+            self.store_prefix(rule, goal)
+        return pos_ids, neg_ids
+
+    # the largest stored rule with the same head whose body is a strict subset of this body
+    def find_prefix(self, rule):
+        head, body = rule
+        for size in range(len(body)-1, 0, -1):
+            for prefix_body in itertools.combinations(body, size):
+                k = rule_key((head, prefix_body))
+                if k in self.prefix_tables:
+                    self.prefix_tables.move_to_end(k)
+                    return prefix_body, self.prefix_tables[k]
+        return None
+
+    def store_prefix(self, rule, goal):
+        head, body = rule
+        table_vars = sorted(set(head.arguments).union(*(literal.arguments for literal in body)))
+        table_id = self.next_prefix_id
+        self.next_prefix_id += 1
+        row = table_literal(table_id, table_vars)
+        budget = self.settings.prefix_cache_mb * 1024 * 1024
+        # a row takes at least a word per argument, so tables with more rows than this never fit
+        max_rows = budget // (8 * (len(table_vars) + 1))
+        # the bindings are only stored if finding them takes no more than testing one example may
+        if self.settings.eval_inferences:
+            limit = f'inferences({self.settings.eval_inferences})'
+        else:
+            limit = f'seconds({self.settings.eval_timeout})'
+        try:
+            stored = self.bool_query(f'store_bindings({row},({goal}),{max_rows},{limit})')
+        except DeadlineExceeded:
+            self.prolog.retractall(row)
+            raise
+        if not stored:
+            return
+        pattern = f'p_{table_id}({",".join(["_"] * (len(table_vars) + 1))})'
+        size = next(self.prolog.query(f'predicate_property({pattern},size(Size))'))['Size']
+        self.prefix_tables[rule_key(rule)] = table_id, table_vars, size
+        self.prefix_bytes += size
+        self.settings.stats.prefix_tables += 1
+        while self.prefix_bytes > budget and self.prefix_tables:
+            _, (old_id, old_vars, old_size) = self.prefix_tables.popitem(last=False)
+            self.prolog.retractall(table_literal(old_id, old_vars))
+            self.prefix_bytes -= old_size
+            self.settings.stats.prefix_cache_evictions += 1
+
+    def clear_prefix_tables(self):
+        for table_id, table_vars, _size in self.prefix_tables.values():
+            self.prolog.retractall(table_literal(table_id, table_vars))
+        self.prefix_tables = OrderedDict()
+        self.prefix_bytes = 0
+
+    # programs are definite, so every superset of an inconsistent program is inconsistent
     def is_inconsistent(self, prog):
         if len(self.neg_index) == 0:
             return False
+        k = prog_key(prog)
+        if k in self.consistency_cache:
+            self.settings.stats.consistency_cache_hits += 1
+            return self.consistency_cache[k]
+        if any(core.issubset(k) for core in self.inconsistent_cores):
+            self.settings.stats.inconsistent_core_hits += 1
+            self.consistency_cache[k] = True
+            return True
         with self.using(prog):
-            return len(list(self.prolog.query("inconsistent"))) > 0
+            first = list(self.limited_query('first_neg_covered(ID)'))
+        inconsistent = len(first) > 0
+        if inconsistent:
+            self.record_coverage([], [first[0]['ID']])
+        self.consistency_cache[k] = inconsistent
+        return inconsistent
+
+    def record_coverage(self, pos_ids, neg_ids):
+        self.pos_hits.update(pos_ids)
+        self.neg_hits.update(neg_ids)
+        if neg_ids:
+            self.settings.stats.inconsistent_programs += 1
+            if not self.top_negs.isdisjoint(neg_ids):
+                self.settings.stats.top_neg_hits += 1
+        self.recorded += 1
+        # with a program budget, the order of the examples decides which ones are cut off
+        if self.recorded % REORDER_INTERVAL == 0 and not self.settings.prog_inferences:
+            self.reorder_examples()
+
+    def reorder_examples(self):
+        for name, index, hits in [('pos_index', self.pos_index, self.pos_hits), ('neg_index', self.neg_index, self.neg_hits)]:
+            order = sorted(index, key=lambda k: -hits[k])
+            if order == self.example_order.get(name, list(index)):
+                continue
+            self.bool_query(f'reorder_examples({name},[{",".join(map(str, order))}])')
+            self.example_order[name] = order
+            self.settings.stats.example_reorders += 1
+        self.top_negs = set(self.example_order.get('neg_index', [])[:TOP_NEGS])
+
+    def add_inconsistent_core(self, prog):
+        k = prog_key(prog)
+        if any(core.issubset(k) for core in self.inconsistent_cores):
+            return
+        self.inconsistent_cores = [core for core in self.inconsistent_cores if not k.issubset(core)]
+        self.inconsistent_cores.append(k)
 
     @contextmanager
     def using(self, prog):
@@ -100,16 +512,74 @@ class Tester():
             prog = order_prog(prog)
         current_clauses = set()
         try:
+            rule_ids = set()
             for rule in prog:
                 head, _body = rule
-                x = format_rule(order_rule(rule))[:-1]
-                self.prolog.assertz(x)
+                rule_id = self.cached_rule_id(rule)
+                rule_ids.add(rule_id)
+                args = tuple(f'V{i}' for i in range(head.arity))
+                dispatch = format_literal(Literal(head.predicate, args))
+                self.prolog.assertz(f'{dispatch}:- {format_literal(Literal(f"r_{rule_id}", args))}')
                 current_clauses.add((head.predicate, head.arity))
+            self.evict_rules(rule_ids)
+            if self.settings.tabling:
+                for predicate, arity in current_clauses:
+                    self.table_pred(predicate, arity)
+            if self.settings.eval_inferences:
+                budget = self.settings.prog_inferences or 'inf'
+                self.bool_query(f'nb_setval(popper_budget,{budget})')
             yield
         finally:
+            if self.settings.eval_inferences:
+                self.count_cutoffs()
             for predicate, arity in current_clauses:
                 args = ','.join(['_'] * arity)
                 self.prolog.retractall(f'{predicate}({args})')
+            # answers tabled for this program are wrong for the next one
+            if self.settings.tabling and current_clauses:
+                self.bool_query('abolish_all_tables')
+
+    def count_cutoffs(self):
+        cutoffs = next(self.prolog.query('flag(popper_cutoffs,N,0)'))['N']
+        if cutoffs:
+            self.settings.stats.eval_cutoffs += cutoffs
+            self.settings.stats.cutoff_programs += 1
+
+    def table_pred(self, predicate, arity):
+        if (predicate, arity) in self.tabled:
+            return
+        self.bool_query(f'table({predicate}/{arity})')
+        self.tabled.add((predicate, arity))
+
+    # each distinct rule is asserted once as r_<id>(Head args):- Body, and a program is
+    # activated by asserting a one-literal dispatch clause Head:- r_<id>(...) per rule
+    def cached_rule_id(self, rule):
+        stats = self.settings.stats
+        k = rule_key(rule)
+        if k in self.rule_cache:
+            self.rule_cache.move_to_end(k)
+            stats.rule_cache_hits += 1
+            return self.rule_cache[k][0]
+
+        stats.rule_cache_misses += 1
+        rule_id = self.next_rule_id
+        self.next_rule_id += 1
+        head, body = order_rule(rule, self.pred_costs)
+        self.prolog.assertz(format_rule((Literal(f'r_{rule_id}', head.arguments), body))[:-1])
+        self.rule_cache[k] = rule_id, head.arity
+        return rule_id
+
+    def evict_rules(self, in_use):
+        # the rules of the program being tested were used last, so eviction stops at them even if
+        # the program has more rules than max_cached_rules
+        while len(self.rule_cache) > self.settings.max_cached_rules:
+            old_id, arity = next(iter(self.rule_cache.values()))
+            if old_id in in_use:
+                break
+            self.rule_cache.popitem(last=False)
+            args = ','.join(['_'] * arity)
+            self.prolog.retractall(f'r_{old_id}({args})')
+            self.settings.stats.rule_cache_evictions += 1
 
     def is_non_functional(self, prog):
         with self.using(prog):
@@ -122,11 +592,45 @@ class Tester():
             subprog = program[:i] + program[i+1:]
             if not prog_is_recursive(subprog):
                 continue
-            with self.using(subprog):
-                if self.is_inconsistent(subprog):
-                    return self.reduce_inconsistent(subprog)
+            if self.is_inconsistent(subprog):
+                return self.reduce_inconsistent(subprog)
+        self.add_inconsistent_core(program)
         return program
 
+    def covers_any_pos(self, prog):
+        k = prog_key(prog)
+        if k not in self.covers_any_cache:
+            with self.using(prog):
+                self.covers_any_cache[k] = self.bool_query('covers_any_pos')
+        return self.covers_any_cache[k]
+
+    # for a single non-recursive rule that covers no positive example, drop body literals one
+    # at a time while the rule still covers none; a specialisation constraint on the smaller
+    # rule prunes every rule that contains it, not only the specialisations of the original
+    def explain_totally_incomplete(self, prog):
+        if len(prog) != 1:
+            return None
+        rule = next(iter(prog))
+        if rule_is_recursive(rule):
+            return None
+        head, body = rule
+        core = frozenset(body)
+        for literal in sorted(body, key=format_literal):
+            if len(core) == 1:
+                break
+            sub_rule = head, core.difference({literal})
+            try:
+                order_rule(sub_rule)
+            except ValueError:
+                # some literal can no longer be grounded
+                continue
+            if not self.covers_any_pos([sub_rule]):
+                core = sub_rule[1]
+        if len(core) == len(body):
+            return None
+        self.settings.stats.explained_literals += len(body) - len(core)
+        return [(head, core)]
+
     def reduce_solution(self, prog):
         if len(prog) < 3:
             return prog
@@ -151,4 +655,36 @@ class Tester():
                 if pos_covered == orignal_covered:
                     return self.reduce_solution_aux(subprog, orignal_covered)
 
-        return prog
\ No newline at end of file
+        return prog
+
+def is_decomposable(prog):
+    # a program covers the union of what its rules cover if every rule defines the same predicate and no rule calls it
+    heads = {head.predicate for head, _body in prog}
+    return len(heads) == 1 and not any(literal.predicate in heads for _head, body in prog for literal in body)
+
+# the direction and type of each argument of a predicate, for each pair of its declarations of that arity,
+# where arguments without a direction are outputs and arguments without a type have any type
+def arg_modes(bias, pred, arity):
+    directions = [ds for ds in bias.directions.get(pred, []) if len(ds) == arity] or [('out',) * arity]
+    types = [ts for ts in bias.types.get(pred, []) if len(ts) == arity] or [('any',) * arity]
+    return [list(zip(ds, ts)) for ds in directions for ts in types]
+
+def body_goal(body):
+    return ','.join(x if isinstance(x, str) else format_literal(x) for x in body)
+
+def table_literal(table_id, table_vars):
+    return f'p_{table_id}(ID,{",".join(table_vars)})'
+
+def ids_to_bits(ids):
+    bits = 0
+    for i in ids:
+        bits |= 1 << (i-1)
+    return bits
+
+def bits_to_ids(bits):
+    ids = []
+    while bits:
+        low = bits & -bits
+        ids.append(low.bit_length())
+        bits ^= low
+    return ids
@@ -1,14 +1,13 @@
-import clingo
-import clingo.script
-import signal
 import argparse
 import os
+import hashlib
 import logging
 from time import perf_counter
 from contextlib import contextmanager
 from .core import Literal
-
-clingo.script.enable_python()
+from .bias import Bias
+from .planner import literal_rank
+from importlib import resources
 
 TIMEOUT=600
 EVAL_TIMEOUT=0.001
@@ -19,8 +18,11 @@ MAX_RULES=2
 MAX_VARS=6
 MAX_BODY=6
 MAX_EXAMPLES=10000
+MAX_CACHED_RULES=10000
+# how many of the most often covered negatives to count the hits of
+TOP_NEGS=10
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description='Popper is an ILP system based on learning from failures')
     parser.add_argument('kbpath', help = 'Path to the knowledge base one wants to learn on')
     # parser.add_argument('--info', default=False, action='store_true', help='Print best programs so ')
@@ -29,12 +31,20 @@ def parse_args():
     parser.add_argument('--stats', default=False, action='store_true', help='Print statistics at end of execution')
 
     parser.add_argument('--timeout', type=float, default=TIMEOUT, help=f'Overall timeout in seconds (default: {TIMEOUT})')
+    parser.add_argument('--phase-budget', type=phase_budget, default=[], action='append', help='Most time to spend in a phase as a fraction of the timeout, e.g. combine=0.2 (can be repeated)')
     parser.add_argument('--eval-timeout', type=float, default=EVAL_TIMEOUT, help=f'Prolog evaluation timeout in seconds (default: {EVAL_TIMEOUT})')
+    parser.add_argument('--eval-inferences', type=int, default=None, help='Prolog evaluation limit in inferences per example, replacing the evaluation timeout')
+    parser.add_argument('--prog-inferences', type=int, default=None, help='Total Prolog inference budget per program across all examples (requires --eval-inferences)')
     parser.add_argument('--max-literals', type=int, default=MAX_LITERALS, help=f'Maximum number of literals allowed in program (default: {MAX_LITERALS})')
     parser.add_argument('--max-body', type=int, default=MAX_BODY, help=f'Maximum number of body literals allowed in rule (default: {MAX_BODY})')
     parser.add_argument('--max-vars', type=int, default=MAX_VARS, help=f'Maximum number of variables allowed in rule (default: {MAX_VARS})')
     parser.add_argument('--max-rules', type=int, default=MAX_RULES, help=f'Maximum number of rules allowed in recursive program (default: {MAX_RULES})')
     parser.add_argument('--max-examples', type=int, default=MAX_EXAMPLES, help=f'Maximum number of examples per label (positive or negative) to learn from (default: {MAX_EXAMPLES})')
+    parser.add_argument('--max-cached-rules', type=int, default=MAX_CACHED_RULES, help=f'Maximum number of rules kept compiled in Prolog between tests (default: {MAX_CACHED_RULES})')
+    parser.add_argument('--memory-budget', type=int, default=None, help='RSS in MB above which caches are cleared and stored programs are spilled to disk')
+    parser.add_argument('--datalog', default=False, action='store_true', help='Test non-recursive rules with a vectorised evaluator (needs numpy) when the bk is only ground facts')
+    parser.add_argument('--order-by-cost', default=False, action='store_true', help='Order body literals by the cost of their predicates, sampled from the bk on the example inputs')
+    parser.add_argument('--prefix-cache-mb', type=int, default=None, help='Keep the body bindings of rules that may be specialised, up to this many MB, and test their specialisations only on the added literals')
 
     # parser.add_argument('--threads', type=int, default=MAX_LITERALS, help=f'Maximum number of threads (default: 1)')
 
@@ -46,37 +56,48 @@ def parse_args():
     parser.add_argument('--bk-file', type=str, default='', help='Filename for the background knowledge')
     parser.add_argument('--bias-file', type=str, default='', help='Filename for the bias')
     parser.add_argument('--bkcons', default=False, action='store_true', help='EXPERIMENTAL FEATURE: deduce background constraints from Datalog background')
+    parser.add_argument('--deepen', default=False, action='store_true', help='Ground the generator one program size at a time, only growing the grounding once a size is exhausted')
+    parser.add_argument('--cegis', type=int, default=None, help='Learn from a working set of this many pos and neg examples, adding up to this many misclassified examples whenever a solution fails on the full set')
+    parser.add_argument('--explain', default=False, action='store_true', help='Prune with the smallest sub-rule that still covers no positive example')
+    parser.add_argument('--tabling', default=False, action='store_true', help='Evaluate hypotheses with SWI tabling so that left-recursive programs terminate')
+    parser.add_argument('--qlf-cache', default=False, action='store_true', help='Load examples from a cached SWI quick-load file (built on first use)')
 
     parser.add_argument('--tactic-file', type=str, default='hspace_tactics.txt', help='Filename for the output tactics')
     parser.add_argument('--precision-bound', type=float, default=0.1, help='Lower bound for allowed precision of tactics')
     parser.add_argument('--recall-bound', type=float, default=0.1, help='Lower bound for allowed recall of tactics')
-    return parser.parse_args()
-
-def timeout(settings, func, args=(), kwargs={}, timeout_duration=1):
-    result = None
-    class TimeoutError(Exception):
-        pass
-
-    def handler(signum, frame):
-        raise TimeoutError()
-
-    # set the timeout handler
-    signal.signal(signal.SIGALRM, handler)
-    signal.alarm(timeout_duration)
-    try:
-        result = func(*args, **kwargs)
-    except TimeoutError as _exc:
-        settings.logger.warn(f'TIMEOUT OF {int(settings.timeout)} SECONDS EXCEEDED')
-        return result
-    except AttributeError as moo:
-        if '_SolveEventHandler' in str(moo):
-            settings.logger.warn(f'TIMEOUT OF {int(settings.timeout)} SECONDS EXCEEDED')
-            return result
-        raise moo
-    finally:
-        signal.alarm(0)
-
-    return result
+    return parser.parse_args(argv)
+
+class DeadlineExceeded(Exception):
+    pass
+
+class Deadline:
+    def __init__(self, duration, stats, budgets={}):
+        self.duration = duration
+        self.end = perf_counter() + duration
+        self.stats = stats
+        # the most time to spend in a phase, as a fraction of the overall time
+        self.budgets = budgets
+
+    def remaining(self):
+        return max(0, self.end - perf_counter())
+
+    def expired(self):
+        return self.remaining() == 0
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded()
+
+    def phase_remaining(self, phase):
+        remaining = self.remaining()
+        if phase in self.budgets:
+            spent = sum(self.stats.durations.get(phase, []))
+            remaining = min(remaining, max(0, self.budgets[phase] * self.duration - spent))
+        return remaining
+
+def phase_budget(arg):
+    phase, fraction = arg.split('=')
+    return phase, float(fraction)
 
 def load_kbpath(kbpath):
     def fix_path(filename):
@@ -84,17 +105,85 @@ def load_kbpath(kbpath):
         return full_filename.replace('\\', '\\\\') if os.name == 'nt' else full_filename
     return fix_path("bk.pl"), fix_path("exs.pl"), fix_path("bias.pl")
 
+def lp_path(filename):
+    return str(resources.files(__package__) / 'lp' / filename)
+
+def file_hash(*paths, extra=''):
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    h.update(extra.encode())
+    return h.hexdigest()
+
 class Stats:
     def __init__(self, info = False, debug = False):
         self.exec_start = perf_counter()
         self.total_programs = 0
         self.durations = {}
+        self.rule_cache_hits = 0
+        self.rule_cache_misses = 0
+        self.rule_cache_evictions = 0
+        self.eval_cutoffs = 0
+        self.cutoff_programs = 0
+        self.consistency_cache_hits = 0
+        self.inconsistent_core_hits = 0
+        self.explained_literals = 0
+        self.cegis_rounds = 0
+        self.coverage_cache_hits = 0
+        self.prefix_cache_hits = 0
+        self.prefix_tables = 0
+        self.prefix_cache_evictions = 0
+        self.datalog_rules = 0
+        self.inconsistent_programs = 0
+        self.top_neg_hits = 0
+        self.example_reorders = 0
+        self.rss_mb = 0
+        self.peak_rss_mb = 0
+        self.memory_cleanups = 0
+        self.memory_cleared = 0
+        self.memory_spilled = 0
+        # the number of entries and approximate size in MB of each structure of the search
+        self.memory = {}
+        self.cegis_examples = 0
+        # whether the search stopped at the timeout rather than finishing
+        self.timed_out = False
 
     def total_exec_time(self):
         return perf_counter() - self.exec_start
 
     def show(self):
         message = f'Num. programs: {self.total_programs}\n'
+        rule_cache_lookups = self.rule_cache_hits + self.rule_cache_misses
+        if rule_cache_lookups:
+            message += f'Rule cache: {self.rule_cache_hits} hits \t {self.rule_cache_misses} misses \t ' + \
+                       f'{self.rule_cache_evictions} evictions \t Hit rate: {self.rule_cache_hits/rule_cache_lookups:0.2f}\n'
+        if self.consistency_cache_hits or self.inconsistent_core_hits:
+            message += f'Consistency checks answered from cache: {self.consistency_cache_hits} \t ' + \
+                       f'from inconsistent cores: {self.inconsistent_core_hits}\n'
+        if self.coverage_cache_hits:
+            message += f'Programs tested from cached rule coverage: {self.coverage_cache_hits}\n'
+        if self.example_reorders:
+            message += f'Example reorders: {self.example_reorders} \t Inconsistent programs covering one of the {TOP_NEGS} most often covered negatives: ' + \
+                       f'{self.top_neg_hits} of {self.inconsistent_programs}\n'
+        if self.datalog_rules:
+            message += f'Rules tested with the Datalog evaluator: {self.datalog_rules}\n'
+        if self.prefix_tables:
+            message += f'Prefix bindings: {self.prefix_tables} stored \t {self.prefix_cache_evictions} evicted \t ' + \
+                       f'Rules tested from a stored prefix: {self.prefix_cache_hits}\n'
+        if self.explained_literals:
+            message += f'Literals removed by explanations: {self.explained_literals}\n'
+        if self.cegis_rounds:
+            message += f'Counterexample rounds: {self.cegis_rounds} \t Examples added: {self.cegis_examples}\n'
+        if self.eval_cutoffs:
+            message += f'Evaluations cut off: {self.eval_cutoffs} in {self.cutoff_programs} programs\n'
+        if self.memory:
+            message += f'RSS: {self.rss_mb:0.0f}MB \t Peak: {self.peak_rss_mb:0.0f}MB'
+            if self.memory_cleanups:
+                message += f' \t Clean ups: {self.memory_cleanups} \t Entries cleared: {self.memory_cleared} \t Entries spilled: {self.memory_spilled}'
+            message += '\n'
+            for name, (entries, size) in self.memory.items():
+                message += f'\t{name}: {entries} entries \t ~{size:0.1f}MB\n'
         total_op_time = 0
         for summary in self.duration_summary():
             message += f'{summary.operation}:\n\tCalled: {summary.called} times \t ' + \
@@ -106,6 +195,12 @@ class Stats:
         message += f'Total execution time: {self.total_exec_time():0.2f}s'
         print(message)
 
+    def to_dict(self):
+        stats = {k: v for k, v in vars(self).items() if type(v) == int}
+        stats['durations'] = {summary.operation: vars(summary) for summary in self.duration_summary()}
+        stats['total_exec_time'] = self.total_exec_time()
+        return stats
+
     def duration_summary(self):
         summary = []
         stats = sorted(self.durations.items(), key = lambda x: sum(x[1]), reverse=True)
@@ -131,6 +226,13 @@ class Stats:
             else:
                 self.durations[operation].append(duration)
 
+def prog_score_to_dict(prog, score):
+    if prog == None:
+        return {'solution': None, 'score': None}
+    solution = [format_rule(order_rule(rule)) for rule in order_prog(prog)]
+    score = dict(zip(('tp', 'fn', 'tn', 'fp', 'size'), map(int, score)))
+    return {'solution': solution, 'score': score}
+
 def format_prog(prog):
     return '\n'.join(format_rule(order_rule(rule)) for rule in prog)
 
@@ -178,6 +280,13 @@ def reduce_prog(prog):
         reduced[k] = rule
     return reduced.values()
 
+def rule_key(rule):
+    head, body = rule
+    return (head.predicate, head.arguments), frozenset((literal.predicate, literal.arguments) for literal in body)
+
+def prog_key(prog):
+    return frozenset(rule_key(rule) for rule in prog)
+
 def order_prog(prog):
     return sorted(list(prog), key=lambda rule: (rule_is_recursive(rule), len(rule[1])))
 
@@ -196,26 +305,27 @@ def rule_is_invented(rule):
         return False
     return head.predicate.startswith('inv')
 
-def order_rule(rule):
+def order_rule(rule, costs=None):
     head, body = rule
+    if head.inputs == []:
+        return rule
+    return head, order_body(rule, body, head.inputs, costs)
+
+# order the literals of a rule body given the variables already grounded before them, cheapest
+# first by the predicate costs if given (see planner.py) and otherwise by their text
+def order_body(rule, body, grounded_variables, costs=None):
+    head, _body = rule
     ordered_body = []
-    grounded_variables = head.inputs
     body_literals = set(body)
 
-    if head.inputs == []:
-        return rule
+    def literal_order(literal):
+        is_check = literal.outputs.issubset(grounded_variables)
+        # the recursive literal goes last
+        return literal.predicate == head.predicate, literal_rank(literal.predicate, is_check, costs), format_literal(literal)
 
     while body_literals:
-        selected_literal = None
-        for literal in body_literals:
-            # AC: could cache for a micro-optimisation
-            if literal.inputs.issubset(grounded_variables):
-                if literal.predicate != head.predicate:
-                    # find the first ground non-recursive body literal and stop
-                    selected_literal = literal
-                else:
-                    # otherwise use the recursive body literal
-                    selected_literal = literal
+        candidates = [literal for literal in body_literals if literal.inputs.issubset(grounded_variables)]
+        selected_literal = min(candidates, key=literal_order, default=None)
 
         if selected_literal == None:
             message = f'{selected_literal} in clause {format_rule(rule)} could not be grounded'
@@ -225,7 +335,7 @@ def order_rule(rule):
         grounded_variables = grounded_variables.union(selected_literal.outputs)
         body_literals = body_literals.difference({selected_literal})
 
-    return head, tuple(ordered_body)
+    return tuple(ordered_body)
 
 class DurationSummary:
     def __init__(self, operation, called, total, mean, maximum):
@@ -239,10 +349,10 @@ def flatten(xs):
     return [item for sublist in xs for item in sublist]
 
 class Settings:
-    def __init__(self, kbpath=False, info=True, debug=False, show_stats=False, bkcons=False, max_literals=MAX_LITERALS, timeout=TIMEOUT, quiet=False, eval_timeout=EVAL_TIMEOUT, max_examples=MAX_EXAMPLES, max_body=MAX_BODY, max_rules=MAX_RULES, max_vars=MAX_VARS, functional_test=False):
+    def __init__(self, kbpath=False, info=True, debug=False, show_stats=False, bkcons=False, max_literals=MAX_LITERALS, timeout=TIMEOUT, quiet=False, eval_timeout=EVAL_TIMEOUT, max_examples=MAX_EXAMPLES, max_body=MAX_BODY, max_rules=MAX_RULES, max_vars=MAX_VARS, functional_test=False, qlf_cache=False, max_cached_rules=MAX_CACHED_RULES, tabling=False, eval_inferences=None, prog_inferences=None, explain=False, deepen=False, phase_budgets=None, cegis=None, prefix_cache_mb=None, order_by_cost=False, datalog=False, memory_budget=None, argv=None):
 
         if kbpath == False:
-            args = parse_args()
+            args = parse_args(argv)
             # info = args.info
             quiet = args.quiet
             debug = args.debug
@@ -257,6 +367,19 @@ class Settings:
             max_vars = args.max_vars
             max_rules = args.max_rules
             functional_test = args.functional_test
+            qlf_cache = args.qlf_cache
+            max_cached_rules = args.max_cached_rules
+            tabling = args.tabling
+            eval_inferences = args.eval_inferences
+            prog_inferences = args.prog_inferences
+            explain = args.explain
+            deepen = args.deepen
+            phase_budgets = dict(args.phase_budget)
+            cegis = args.cegis
+            prefix_cache_mb = args.prefix_cache_mb
+            order_by_cost = args.order_by_cost
+            datalog = args.datalog
+            memory_budget = args.memory_budget
             tactic_file = args.tactic_file
             precision_bound = args.precision_bound
             recall_bound = args.recall_bound
@@ -282,6 +405,19 @@ class Settings:
         self.max_literals = max_literals
         # self.clingo_args = [] if not args.clingo_args else args.clingo_args.split(' ')
         self.functional_test = functional_test
+        self.qlf_cache = qlf_cache
+        self.max_cached_rules = max_cached_rules
+        self.tabling = tabling
+        self.eval_inferences = eval_inferences
+        self.prog_inferences = prog_inferences
+        self.explain = explain
+        self.deepen = deepen
+        self.phase_budgets = phase_budgets or {}
+        self.cegis = cegis
+        self.prefix_cache_mb = prefix_cache_mb
+        self.order_by_cost = order_by_cost
+        self.datalog = datalog
+        self.memory_budget = memory_budget
         self.timeout = timeout
         self.eval_timeout = eval_timeout
         self.max_examples = max_examples
@@ -296,37 +432,17 @@ class Settings:
         self.best_prog_score = None
         # self.best_prog = None
 
-        solver = clingo.Control()
-        with open(self.bias_file) as f:
-            solver.add('bias', [], f.read())
-        solver.add('bias', [], """
-            #defined body_literal/4.
-            #defined clause/1.
-            #defined clause_var/2.
-            #defined var_type/3.
-            #defined body_size/2.
-            #defined recursive/0.
-            #defined var_in_literal/4.
-        """)
-        solver.ground([('bias', [])])
-
-        for x in solver.symbolic_atoms.by_signature('max_body', arity=1):
-            self.max_body = x.symbol.arguments[0].number
-
-        for x in solver.symbolic_atoms.by_signature('max_vars', arity=1):
-            self.max_vars = x.symbol.arguments[0].number
-
-        self.max_rules = None
-        for x in solver.symbolic_atoms.by_signature('max_clauses', arity=1):
-            self.max_rules = x.symbol.arguments[0].number
-
-        self.recursion_enabled = False
-        for x in solver.symbolic_atoms.by_signature('enable_recursion', arity=0):
-            self.recursion_enabled = True
-
-        self.pi_enabled = False
-        for x in solver.symbolic_atoms.by_signature('enable_pi', arity=0):
-            self.pi_enabled = True
+        self.bias = Bias(self.bias_file)
+
+        if self.bias.max_body != None:
+            self.max_body = self.bias.max_body
+
+        if self.bias.max_vars != None:
+            self.max_vars = self.bias.max_vars
+
+        self.max_rules = self.bias.max_clauses
+        self.recursion_enabled = self.bias.recursion_enabled
+        self.pi_enabled = self.bias.pi_enabled
 
         if self.max_rules == None:
             if self.recursion_enabled or self.pi_enabled:
@@ -15,6 +15,9 @@ setuptools.setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     py_modules=['popper'],
+    entry_points={
+        'console_scripts': ['popper-batch=popper.batch:main'],
+    },
     install_requires=[
         'clingo',
         'pyswip'
@@ -10,11 +10,29 @@ logger = logging.getLogger(__name__)
 import numpy as np
 import pandas as pd
 
+METRIC_COLUMNS = ['match', 'num_suggestions', 'correct_move', 'tactic_ground_div', 'tactic_ground_avg']
+
+def read_metrics(metrics_file: str) -> pd.DataFrame:
+    if metrics_file.endswith('.parquet'):
+        return pd.read_parquet(metrics_file)
+    return pd.read_csv(metrics_file)
+
+def aggregate_metrics(df: pd.DataFrame) -> pd.DataFrame:
+    "Sum the metric columns per tactic, ignoring missing values, and derive divergence, coverage and accuracy"
+    codes, tactics = pd.factorize(df['tactic_text'], sort=True)
+    agg = pd.DataFrame({'tactic_text': np.asarray(tactics, dtype=object)})
+    for column in METRIC_COLUMNS:
+        values = np.nan_to_num(pd.to_numeric(df[column], errors='coerce').to_numpy(dtype=np.float64))
+        agg[column] = np.bincount(codes, weights=values, minlength=len(tactics))
+    num_positions = len(df[['position', 'move']].drop_duplicates())
+    with np.errstate(divide='ignore', invalid='ignore'):
+        agg['avg_tactic_ground_avg'] = agg['tactic_ground_avg'] / agg['match']
+        agg['coverage'] = agg['match'] / num_positions
+        agg['accuracy'] = agg['correct_move'] / agg['match']
+    return agg
+
 def get_top_tactics(df, filter: Optional[int]) -> List[str]:
-    agg = df.groupby('tactic_text').aggregate(np.nansum).reset_index()
-    agg['avg_tactic_ground_avg'] = agg['tactic_ground_avg'] / agg['match']
-    # agg['coverage'] = agg['matches'] / df.groupby(['position', 'move']).ngroups
-    # agg['accuracy'] = agg['correct_move'] / agg['matches']
+    agg = aggregate_metrics(df)
     final = agg.sort_values(by = ['avg_tactic_ground_avg'], ascending = [True])
     tactics = list(final['tactic_text'])
     if filter:
@@ -33,7 +51,7 @@ def parse_args():
 def main():
     args = parse_args()
 
-    df = pd.read_csv(args.metrics_file)
+    df = read_metrics(args.metrics_file)
     tactics = get_top_tactics(df, args.filter_limit)
     tactic_str = '\n'.join([tactic + '.' for tactic in tactics])
     if not args.output_file:
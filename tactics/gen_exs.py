@@ -1,13 +1,19 @@
 import argparse
 import csv
+import io
 import logging
+import mmap
+import multiprocessing
+import multiprocessing.util
 import os
 import random
-from typing import List, Optional, TextIO
+from contextlib import nullcontext
+from typing import Dict, Generator, List, Optional, Tuple
 
 import chess
 import chess.engine
 import chess.pgn
+import numpy as np
 
 from fen_to_contents import fen_to_contents, uci_to_move
 from util import LICHESS_2013, get_lc0_cmd, LC0, MAIA_1600, PathLike, get_engine, get_top_n_moves
@@ -17,41 +23,106 @@ logger = logging.getLogger(__name__)
 
 BRATKO = 12 # Guid, Matej, and Ivan Bratko. "Computer analysis of world chess champions." ICGA journal 29.2 (2006): 65-73.
 ROMERO = 7 # Romero, Oscar. "Computer analysis of world chess championship players." ICSEA 2019 (2019): 212.
-
-def game_to_ex_list(game: Optional[chess.pgn.Game], opening_cutoff: int=ROMERO) -> List[chess.Board]:
-    "Convert a game to a list of training examples"
-
-    examples = []
-
-    if not game:
-        return examples
-    
-    node = game.next()
-    while node:
-        board = node.parent.board()
-        move = node.move
-        examples.append((board, move))
-        node = node.next()
-
-    return examples[opening_cutoff * 2:]
-
-def sample_pgn(handle: TextIO, num_games, pos_per_game) -> List[chess.Board]:
+CHUNKSIZE = 16
+
+def read_game_moves(pgn_text: str) -> Tuple[str, chess.Board, List[chess.Move]]:
+    "Parse the text of a single game into its site, starting position and mainline moves"
+
+    game = chess.pgn.read_game(io.StringIO(pgn_text))
+    return game.headers['Site'], game.board(), list(game.mainline_moves())
+
+def game_to_ex_list(moves: List[chess.Move], opening_cutoff: int=ROMERO) -> range:
+    "Return the indices of the moves in a game that can be used as training examples"
+
+    return range(opening_cutoff * 2, len(moves))
+
+TERMINATIONS = ['Normal', 'Time forfeit', 'Abandoned', 'Rules infraction']
+INDEX_DTYPE = np.dtype([
+    ('offset', np.int64),
+    ('termination', np.int8),
+    ('white_elo', np.int16),
+    ('black_elo', np.int16),
+    ('num_moves', np.int16),
+])
+
+class IndexVisitor(chess.pgn.BaseVisitor):
+    "PGN visitor collecting the headers and number of mainline moves of a game without parsing the moves"
+
+    def begin_game(self) -> None:
+        self.headers: Dict[str, str] = {}
+        self.num_moves = 0
+
+    def visit_header(self, tagname: str, tagvalue: str) -> None:
+        self.headers[tagname] = tagvalue
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def begin_parse_san(self, board: chess.Board, san: str):
+        self.num_moves += 1
+        return chess.pgn.SKIP
+
+    def result(self) -> Tuple[Dict[str, str], int]:
+        return self.headers, self.num_moves
+
+def parse_elo(elo: Optional[str]) -> int:
+    return int(elo) if elo and elo.isdigit() else -1
+
+def index_path(pgn_path: PathLike) -> str:
+    return f'{pgn_path}.idx.npy'
+
+def build_pgn_index(pgn_path: PathLike) -> np.ndarray:
+    "Scan a PGN file once and record the byte offset, termination, Elo ratings and length of every game"
+
+    rows = []
+    with open(pgn_path, encoding='utf-8') as handle:
+        while True:
+            offset = handle.tell()
+            game = chess.pgn.read_game(handle, Visitor=IndexVisitor)
+            if game is None:
+                break
+            headers, num_moves = game
+            termination = headers.get('Termination')
+            termination = TERMINATIONS.index(termination) if termination in TERMINATIONS else -1
+            rows.append((offset, termination, parse_elo(headers.get('WhiteElo')), parse_elo(headers.get('BlackElo')), min(num_moves, np.iinfo(np.int16).max)))
+    rows.append((os.path.getsize(pgn_path), -1, -1, -1, 0)) # sentinel marking the end of the last game
+    return np.array(rows, dtype=INDEX_DTYPE)
+
+def load_pgn_index(pgn_path: PathLike) -> np.ndarray:
+    "Load the offset index of a PGN file, building it if it is missing or stale"
+
+    path = index_path(pgn_path)
+    if os.path.exists(path):
+        index = np.load(path, mmap_mode='r')
+        if len(index) and index['offset'][-1] == os.path.getsize(pgn_path):
+            return index
+        logger.info(f'Stale index {path}, rebuilding')
+    index = build_pgn_index(pgn_path)
+    np.save(path, index)
+    logger.info(f'Wrote index of {len(index) - 1} games to {path}')
+    return index
+
+def filter_pgn_index(index: np.ndarray, min_elo: Optional[int]=None, min_moves: int=0) -> np.ndarray:
+    "Return the positions in the index of games that are eligible for sampling"
+
+    games = index[:-1]
+    mask = np.isin(games['termination'], [TERMINATIONS.index('Normal'), TERMINATIONS.index('Time forfeit')])
+    if min_elo:
+        mask &= (games['white_elo'] >= min_elo) & (games['black_elo'] >= min_elo)
+    if min_moves:
+        mask &= games['num_moves'] >= min_moves
+    return np.flatnonzero(mask)
+
+def sample_pgn(pgn_path: PathLike, num_games: int, pos_per_game: int, min_elo: Optional[int]=None, min_moves: int=0, jobs: int=1) -> List[Tuple[chess.Board, chess.Move]]:
     "Sample training examples from games in a PGN file"
     
     # obtain num_game offsets from list of games in PGN
     rand_state = random.getstate()
 
-    offsets = []
-    while True:
-        offset = handle.tell()
-
-        header = chess.pgn.read_headers(handle)
-        if header is None:
-            break
-
-        termination = header.get("Termination")
-        if termination in ["Normal", "Time forfeit"]:
-            offsets.append(offset)
+    index = load_pgn_index(pgn_path)
+    eligible = filter_pgn_index(index, min_elo=min_elo, min_moves=min_moves)
+    offsets = index['offset'][eligible].tolist()
+    ends = dict(zip(offsets, index['offset'][eligible + 1].tolist()))
     sampled_offsets = random.sample(offsets, min(num_games, len(offsets)))
     logger.info(f'# of games = {len(offsets)}')
     logger.info(f'Sampled games = {len(sampled_offsets)}')
@@ -59,32 +130,65 @@ def sample_pgn(handle: TextIO, num_games, pos_per_game) -> List[chess.Board]:
     # obtain pos_per_game examples from every game in sampled list of games
     random.setstate(rand_state) # to ensure same examples are picked for each game
 
+    with open(pgn_path, 'rb') as handle, mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as pgn:
+        pgn_texts = [pgn[offset:ends[offset]].decode('utf-8') for offset in sampled_offsets]
+
+    # games are parsed in parallel, but examples are sampled here in game order so that the
+    # same seed picks the same examples regardless of the number of jobs
     result = []
-    for offset in sampled_offsets:
-        handle.seek(offset)
-        game = chess.pgn.read_game(handle)
-        examples = game_to_ex_list(game)
-        logger.info(f'Game: {game.headers["Site"]}, # of exs = {len(examples)}')
-        sampled_examples = random.sample(examples, min(pos_per_game, len(examples)))
-        result.extend(sampled_examples)
+    with multiprocessing.Pool(jobs) if jobs > 1 else nullcontext() as pool:
+        games = pool.imap(read_game_moves, pgn_texts, chunksize=CHUNKSIZE) if pool else map(read_game_moves, pgn_texts)
+        for site, board, moves in games:
+            examples = game_to_ex_list(moves)
+            logger.info(f'Game: {site}, # of exs = {len(examples)}')
+            for idx in random.sample(examples, min(pos_per_game, len(examples))):
+                position = board.copy()
+                for move in moves[:idx]:
+                    position.push(move)
+                result.append((position, moves[idx]))
     return result
 
-def gen_exs(exs_pgn_path: PathLike, num_games: int, pos_per_game: int, neg_to_pos_ratio: int=0, use_engine: bool=False, engine_path: Optional[PathLike]=None):
+pool_engine = None
+
+def init_engine(engine_path: PathLike) -> None:
+    "Open one engine per pool worker, to be closed when the worker exits"
+
+    global pool_engine
+    pool_engine = chess.engine.SimpleEngine.popen_uci(engine_path)
+    multiprocessing.util.Finalize(None, pool_engine.quit, exitpriority=10)
+
+def pool_top_n_moves(task: Tuple[chess.Board, int]) -> List[chess.Move]:
+    board, n = task
+    return get_top_n_moves(pool_engine, board, n)
+
+def label_examples(position: chess.Board, move: chess.Move, moves: List[chess.Move]) -> Generator[dict, None, None]:
+    "Yield the ground truth move as a positive example and the other engine moves as negative examples"
+
+    if not moves:
+        return
+    top_move = move # pos example is ground truth move
+    yield {'fen': position.fen(), 'uci': top_move.uci(), 'label': 1}
+    for move in moves[1:]:
+        if move != top_move:
+            yield {'fen': position.fen(), 'uci': move.uci(), 'label': 0} # neg examples are engine moves
+
+def gen_exs(exs_pgn_path: PathLike, num_games: int, pos_per_game: int, neg_to_pos_ratio: int=0, use_engine: bool=False, engine_path: Optional[PathLike]=None, min_elo: Optional[int]=None, min_moves: int=0, jobs: int=1):
     
-    with open(exs_pgn_path) as handle:
-        sample_examples = sample_pgn(handle, num_games=num_games, pos_per_game=pos_per_game)
+    sample_examples = sample_pgn(exs_pgn_path, num_games=num_games, pos_per_game=pos_per_game, min_elo=min_elo, min_moves=min_moves, jobs=jobs)
     
-    if use_engine:
+    if use_engine and jobs > 1:
+        with multiprocessing.Pool(jobs, initializer=init_engine, initargs=(engine_path,)) as pool:
+            tasks = ((position, neg_to_pos_ratio + 1) for position, _ in sample_examples)
+            # imap keeps the results in the order of the sampled examples
+            for (position, move), moves in zip(sample_examples, pool.imap(pool_top_n_moves, tasks, chunksize=CHUNKSIZE)):
+                yield from label_examples(position, move, moves)
+            pool.close()
+            pool.join()
+    elif use_engine:
         with get_engine(engine_path) as engine:
             for position, move in sample_examples:
                 moves = get_top_n_moves(engine, position, neg_to_pos_ratio + 1)
-                if not moves:
-                    continue
-                top_move = move # pos example is ground truth move
-                yield {'fen': position.fen(), 'uci': top_move.uci(), 'label': 1}
-                for move in moves[1:]:
-                    if move != top_move:
-                        yield {'fen': position.fen(), 'uci': move.uci(), 'label': 0} # neg examples are engine moves
+                yield from label_examples(position, move, moves)
     else:
         for position, move in sample_examples:
             yield {'fen': position.fen(), 'uci': move.uci(), 'label': 1}
@@ -97,8 +201,11 @@ def parse_args():
     parser.add_argument('-n', '--num-games', dest='num_games', type=int, default=10, help='Number of games to use')
     parser.add_argument('-p', '--pos-per-game', dest='pos_per_game', type=int, default=10, help='Number of positions to use per game')
     parser.add_argument('-r', '--ratio', dest='neg_to_pos_ratio', type=int, default=2, help='Ratio of negative to positive examples to generate')
+    parser.add_argument('--min-elo', dest='min_elo', type=int, default=None, help='Only sample games where both players are rated at least this')
+    parser.add_argument('--min-moves', dest='min_moves', type=int, default=0, help='Only sample games with at least this many half-moves')
     parser.add_argument('--seed', dest='seed', type=int, default=1, help='Seed to use for random generation')
     parser.add_argument('--use-engine', action='store_true', help='Use engine to generate moves for the examples')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1, help='Number of worker processes (and engines) to use')
     return parser.parse_args()
 
 def main():
@@ -111,11 +218,11 @@ def main():
             field_names = ['fen', 'uci', 'label']
             writer = csv.DictWriter(output, fieldnames=field_names)
             writer.writeheader()
-            for ex in gen_exs(args.pgn_file, args.num_games, args.pos_per_game, args.neg_to_pos_ratio, args.use_engine, args.engine_path):
+            for ex in gen_exs(args.pgn_file, args.num_games, args.pos_per_game, args.neg_to_pos_ratio, args.use_engine, args.engine_path, args.min_elo, args.min_moves, args.jobs):
                 writer.writerow(ex)
         else: # Prolog default for unknown file extension
             output.write(':- discontiguous pos/1.\n:- discontiguous neg/1.\n\n')
-            for ex in gen_exs(args.pgn_file, args.num_games, args.pos_per_game, args.neg_to_pos_ratio, args.use_engine, args.engine_path):
+            for ex in gen_exs(args.pgn_file, args.num_games, args.pos_per_game, args.neg_to_pos_ratio, args.use_engine, args.engine_path, args.min_elo, args.min_moves, args.jobs):
                 fen, move, label = ex['fen'], ex['uci'], ex['label']
                 # print(fen, move, label)
                 contents = fen_to_contents(fen)
@@ -11,6 +11,8 @@ import pandas as pd
 import matplotlib
 import matplotlib.pyplot as plt
 
+from analysis import aggregate_metrics, read_metrics
+
 matplotlib.use("pgf")
 matplotlib.rcParams.update({
     "pgf.texsystem": "pdflatex",
@@ -20,13 +22,6 @@ matplotlib.rcParams.update({
 })
 
 
-def calculate_metrics(df): # TODO: refactor this and the method in analysis.py
-    agg = df.groupby('tactic_text').aggregate(np.nansum).reset_index()
-    agg['avg_tactic_ground_avg'] = agg['tactic_ground_avg'] / agg['match']
-    agg['coverage'] = agg['match'] / df.groupby(['position', 'move']).ngroups
-    agg['accuracy'] = agg['correct_move'] / agg['match']
-    return agg
-
 def generate_frequency_graph(df, metric_fname: str, filename: str, title: str='?', xlabel: str=None, bins: int=20, left: int=0, right: Optional[int]=None):
     mask = df['tactic_text'].isin(['ground', 'sf14', 'maia_1600', 'random'])
     df_masked = df[~mask]
@@ -58,8 +53,8 @@ def parse_args():
 def main():
     args = parse_args()
 
-    df = pd.read_csv(args.metrics_file)
-    df_metrics = calculate_metrics(df)
+    df = read_metrics(args.metrics_file)
+    df_metrics = aggregate_metrics(df)
     generate_frequency_graph(df_metrics, args.metric, args.output_name, args.title, args.xlabel, args.bins, args.left, args.right)
 
 if __name__ == '__main__':
@@ -1,20 +1,26 @@
 import argparse
 import csv
+import glob
 import logging
 import math
+import os
 import random
+import time
 from collections.abc import Callable
 from typing import Generator, List, Optional, Tuple, Dict
 
 import chess
 import chess.engine
 import chess.pgn
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pyparsing
 from pyswip import Prolog
 from pyswip.prolog import Prolog
 from tqdm import tqdm
 
-from prolog_parser import create_parser, parse_result_to_str
+from prolog_parser import create_parser, parse_result_to_str, load_pred_costs
 from util import *
 
 logger = logging.getLogger(__name__)
@@ -22,6 +28,9 @@ logger.propagate = False # https://stackoverflow.com/a/2267567
 
 SUGGESTIONS_PER_TACTIC = -1
 NUM_ENGINE_MOVES = 1
+BATCH_SIZE = 1 << 16
+PARQUET_FLUSH_SECONDS = 300 # most time between parquet parts, so a crash loses at most this much work
+NA = -1 # missing value in the integer columns
 dcg_fn = lambda idx, error: error / math.log2(1 + (idx + 1))
 avg_fn = lambda _, error: error
 
@@ -53,57 +62,206 @@ def get_tactic_match(prolog: Prolog, text: str, board: chess.Board, limit: int=3
     
     return match, suggestions
 
-def get_tactic_evals(prolog: Prolog, tactic_text: str, board: chess.Board, limit: int, engine: chess.engine.SimpleEngine, args) -> Tuple[bool, List[Tuple[chess.Move, int]]]:
-    "Obtain tactic suggestions and return their engine evaluations for a given position"
-    
-    match, suggestions = get_tactic_match(prolog, tactic_text, board, limit=limit, time_limit_sec=args.eval_timeout)
-    logger.debug(f'Suggestions: {suggestions}')
-    tactic_evals = []
-    if match and suggestions:
-        tactic_evals = get_evals(engine, board, suggestions, mate_score=args.mate_score)
-    logger.debug(f'Match: {str(match)}, Evals: {str(tactic_evals)}')
-    return match, tactic_evals
-
-def print_metrics(metrics: dict, log_level=logging.INFO) -> None:
+def get_position_evals(engine: chess.engine.SimpleEngine, board: chess.Board, suggestion_lists: List[List[chess.Move]], args) -> List[List[Tuple[chess.Move, int]]]:
+    "Obtain the engine evaluations of every list of suggested moves for a position"
+
+    if args.batch_evals:
+        return get_evals_batch(engine, board, suggestion_lists, mate_score=args.mate_score)
+    return [get_evals(engine, board, suggestions, mate_score=args.mate_score) for suggestions in suggestion_lists]
+
+def print_metrics(metrics: tuple, log_level=logging.INFO) -> None:
     logger.log(log_level, metrics)
 
-def write_metrics(metrics_list: List[dict], csv_filename: str) -> None:
-    "Write metrics to csv file for analysis"
-    with open(csv_filename, 'w') as csv_file:
-        field_names = list(metrics_list[0].keys())
-        writer = csv.DictWriter(csv_file, fieldnames=field_names)
-        writer.writeheader()
-        for metrics in metrics_list:
-            writer.writerow(metrics)
-
-def calc_metrics(tactic_evals: List[Tuple[chess.Move, int]], ground_eval: Tuple[chess.Move, int], **kwargs) -> dict:
-    "Calculate metrics from evaluating a tactic against a position"
-
-    board, move, label = kwargs['example']
-    logger.debug(board)
-    prefix = kwargs['prefix']
-
-    metrics = {
-        'match': 0,
-        'num_suggestions': 0,
-        'correct_move': 0,
-        'tactic_text': kwargs['tactic_text'],
-        'move': move.uci(),
-        'position': board.fen()
-    }
-
-    if kwargs['match']:
-        metrics['match'] = 1
-        metrics[f'{prefix}_div'] = evaluate(tactic_evals, ground_eval, dcg_fn)
-        metrics[f'{prefix}_avg'] = evaluate(tactic_evals, ground_eval, avg_fn)
-        metrics['correct_move'] = int(move in [tactic_eval[0] for tactic_eval in tactic_evals])
-        metrics['num_suggestions'] = len(tactic_evals)
+class MetricsTable:
+    "Columnar store of metrics, with interned tactics and positions, flushed to disk in batches"
+
+    def __init__(self, path: str, prefix: str='tactic_ground', batch_size: int=BATCH_SIZE, resume: bool=False):
+        self.path = path
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.is_parquet = path.endswith('.parquet')
+
+        self.tactics: List[str] = []
+        self.tactic_ids: Dict[str, int] = {}
+        self.positions: List[Tuple[str, str]] = []
+        self.position_ids: Dict[Tuple[str, str], int] = {}
+
+        self.tactic_id = np.empty(batch_size, dtype=np.int32)
+        self.position_id = np.empty(batch_size, dtype=np.int32)
+        self.match = np.empty(batch_size, dtype=np.int8)
+        self.num_suggestions = np.empty(batch_size, dtype=np.int32)
+        self.correct_move = np.empty(batch_size, dtype=np.int8)
+        self.div = np.empty(batch_size, dtype=np.float64)
+        self.avg = np.empty(batch_size, dtype=np.float64)
+        self.size = 0
+        self.num_rows = 0
+        self.num_parts = 0
+        self.last_flush = time.monotonic()
+
+        self.writer = None
+        self.csv_file = None
+
+        if self.is_parquet and os.path.isfile(path):
+            self.convert_single_file()
+
+        # (tactic_id, position_id) pairs already written by a previous run
+        self.done = set()
+        if resume and os.path.exists(path):
+            self.load_existing()
+        elif self.is_parquet and os.path.isdir(path):
+            for part in glob.glob(os.path.join(path, 'part-*.parquet')):
+                os.remove(part)
+
+    def load_existing(self) -> None:
+        "Intern the tactics and positions of the rows written by a previous run"
+        if self.is_parquet:
+            parts = sorted(glob.glob(os.path.join(self.path, 'part-*.parquet')))
+            self.num_parts = len(parts)
+            rows = pq.read_table(self.path, columns=['tactic_text', 'position', 'move']).to_pydict() if parts else {'tactic_text': [], 'position': [], 'move': []}
+        else:
+            self.truncate_partial_row()
+            with open(self.path, newline='') as csv_file:
+                rows = {'tactic_text': [], 'position': [], 'move': []}
+                for row in csv.DictReader(csv_file):
+                    for k, v in rows.items():
+                        v.append(row[k])
+        for tactic_text, fen, move in zip(rows['tactic_text'], rows['position'], rows['move']):
+            self.done.add((self.intern_tactic(tactic_text), self.intern_position_key((fen, move))))
+        self.num_rows = len(self.done)
+        logger.info(f'Resuming from {self.num_rows} rows in {self.path}')
+
+    def convert_single_file(self) -> None:
+        "Turn a single .parquet file, as written by earlier versions, into the first part of a dataset at the same path"
+        tmp_path = f'{self.path}.tmp'
+        os.replace(self.path, tmp_path)
+        os.makedirs(self.path)
+        os.replace(tmp_path, os.path.join(self.path, 'part-00000.parquet'))
+        logger.info(f'Moved the rows in {self.path} to {self.path}/part-00000.parquet')
+
+    def truncate_partial_row(self) -> None:
+        "Drop a trailing row left incomplete by a crash"
+        with open(self.path, 'rb+') as csv_file:
+            data = csv_file.read()
+            if data and not data.endswith(b'\n'):
+                csv_file.truncate(data.rfind(b'\n') + 1)
+
+    def is_done(self, tactic_id: int, position_id: int) -> bool:
+        return (tactic_id, position_id) in self.done
+
+    def intern_tactic(self, tactic_text: str) -> int:
+        if tactic_text not in self.tactic_ids:
+            self.tactic_ids[tactic_text] = len(self.tactics)
+            self.tactics.append(tactic_text)
+        return self.tactic_ids[tactic_text]
+
+    def intern_position(self, board: chess.Board, move: chess.Move) -> int:
+        return self.intern_position_key((board.fen(), move.uci()))
+
+    def intern_position_key(self, k: Tuple[str, str]) -> int:
+        if k not in self.position_ids:
+            self.position_ids[k] = len(self.positions)
+            self.positions.append(k)
+        return self.position_ids[k]
+
+    def append(self, tactic_id: int, position_id: int, metrics: tuple) -> None:
+        i = self.size
+        self.tactic_id[i] = tactic_id
+        self.position_id[i] = position_id
+        self.match[i], self.num_suggestions[i], self.correct_move[i], self.div[i], self.avg[i] = metrics
+        self.size += 1
+        if self.size == self.batch_size:
+            self.flush()
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        n = self.size
+        return {
+            'match': self.match[:n],
+            'num_suggestions': self.num_suggestions[:n],
+            'correct_move': self.correct_move[:n],
+            f'{self.prefix}_div': self.div[:n],
+            f'{self.prefix}_avg': self.avg[:n],
+        }
+
+    def flush(self) -> None:
+        "Write the current batch to disk and start a new one"
+        self.last_flush = time.monotonic()
+        if self.size == 0:
+            return
+        if self.is_parquet:
+            self.flush_parquet()
+        else:
+            self.flush_csv()
+        self.num_rows += self.size
+        self.size = 0
+
+    def checkpoint(self) -> None:
+        "Write the rows so far at the end of a position: always for CSV, and for parquet once PARQUET_FLUSH_SECONDS have passed"
+        if not self.is_parquet or time.monotonic() - self.last_flush >= PARQUET_FLUSH_SECONDS:
+            self.flush()
+
+    def flush_parquet(self) -> None:
+        n = self.size
+        columns = {name: pa.array(values, mask=values == NA if values.dtype.kind == 'i' else None) for name, values in self.columns().items()}
+        # the dictionaries only hold the tactics and positions of this batch
+        tactic_ids, tactic_idx = np.unique(self.tactic_id[:n], return_inverse=True)
+        position_ids, position_idx = np.unique(self.position_id[:n], return_inverse=True)
+        fens, moves = zip(*[self.positions[i] for i in position_ids])
+        position_idx = pa.array(position_idx.astype(np.int32))
+        columns['tactic_text'] = pa.DictionaryArray.from_arrays(pa.array(tactic_idx.astype(np.int32)), pa.array([self.tactics[i] for i in tactic_ids]))
+        columns['move'] = pa.DictionaryArray.from_arrays(position_idx, pa.array(moves))
+        columns['position'] = pa.DictionaryArray.from_arrays(position_idx, pa.array(fens))
+        # every batch goes to its own part file, written under a hidden name and renamed once
+        # complete, so that a crash never leaves an unreadable dataset behind
+        os.makedirs(self.path, exist_ok=True)
+        part = f'part-{self.num_parts:05d}.parquet'
+        tmp_path = os.path.join(self.path, f'.{part}.tmp')
+        pq.write_table(pa.Table.from_batches([pa.RecordBatch.from_pydict(columns)]), tmp_path)
+        os.replace(tmp_path, os.path.join(self.path, part))
+        self.num_parts += 1
+
+    def flush_csv(self) -> None:
+        columns = self.columns()
+        field_names = ['match', 'num_suggestions', 'correct_move', 'tactic_text', 'move', 'position', f'{self.prefix}_div', f'{self.prefix}_avg']
+        if self.csv_file is None:
+            append = self.num_rows > 0 or bool(self.done)
+            self.csv_file = open(self.path, 'a' if append else 'w', newline='')
+            self.writer = csv.writer(self.csv_file)
+            if not append:
+                self.writer.writerow(field_names)
+        na = lambda x: 'n/a' if x == NA or x != x else x
+        for i in range(self.size):
+            fen, move = self.positions[self.position_id[i]]
+            self.writer.writerow([
+                na(columns['match'][i]), na(columns['num_suggestions'][i]), na(columns['correct_move'][i]),
+                self.tactics[self.tactic_id[i]], move, fen,
+                na(columns[f'{self.prefix}_div'][i]), na(columns[f'{self.prefix}_avg'][i]),
+            ])
+        self.csv_file.flush()
+
+    def close(self) -> None:
+        self.flush()
+        if self.csv_file is not None:
+            self.csv_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def calc_metrics(tactic_evals: List[Tuple[chess.Move, int]], ground_eval: Tuple[chess.Move, int], move: chess.Move, match: Optional[bool]) -> tuple:
+    "Calculate (match, num_suggestions, correct_move, div, avg) from evaluating a tactic against a position"
+
+    if match:
+        metrics = (
+            1,
+            len(tactic_evals),
+            int(move in [tactic_eval[0] for tactic_eval in tactic_evals]),
+            evaluate(tactic_evals, ground_eval, dcg_fn),
+            evaluate(tactic_evals, ground_eval, avg_fn),
+        )
     else:
-        metrics['match'] = 0 if kwargs['match'] is False else 'n/a'
-        metrics[f'{prefix}_div'] = 'n/a'
-        metrics[f'{prefix}_avg'] = 'n/a'
-        metrics['correct_move'] = 'n/a'
-        metrics['num_suggestions'] = 'n/a'
+        metrics = (0 if match is False else NA, NA, NA, math.nan, math.nan)
     
     print_metrics(metrics, log_level=logging.DEBUG)
     return metrics
@@ -117,11 +275,14 @@ def parse_args():
     parser.add_argument('--pgn', dest='pgn_file', default=LICHESS_2013, help='Path to PGN file of positions to use for calculating divergence')
     parser.add_argument('--num-games', dest='num_games', type=int, default=10, help='Number of games to use')
     parser.add_argument('--pos-per-game', dest='pos_per_game', type=int, default=10, help='Number of positions to use per game')
-    parser.add_argument('--data-path', dest='data_path', type=str, default='tactics/data/stats/metrics_data.csv', help='File path to which metrics should be written')
+    parser.add_argument('--data-path', dest='data_path', type=str, default='tactics/data/stats/metrics_data.csv', help='File path to which metrics should be written (.csv or .parquet)')
     parser.add_argument('--pos-list', dest='pos_list', type=str, help='Path to file contatining list of positions to use for calculating divergence')
     parser.add_argument('--eval-timeout', type=int, default=None, help='Prolog evaluation timeout in seconds')
     parser.add_argument('--mate-score', type=int, default=2000, help='Score to use to approximate a Mate in X evaluation')
     parser.add_argument('--seed', type=int, default=1, help='Seed to use for random tactic')
+    parser.add_argument('--pred-costs', type=str, default=None, help='Order tactic bodies by the predicate costs Popper saves with --order-by-cost (a costs-*.json file in .popper_cache)')
+    parser.add_argument('--no-batch-evals', dest='batch_evals', action='store_false', help='Analyse every suggested move on its own instead of all the distinct moves of a position in one multi-PV search')
+    parser.add_argument('--resume', action='store_true', help='Keep the rows already in --data-path and only evaluate the missing (position, tactic) pairs. Batched evals are not comparable with rows written without them, including by versions before batching, so resume such data with --no-batch-evals')
     return parser.parse_args()
 
 def create_logger(log_level):
@@ -134,7 +295,7 @@ def create_logger(log_level):
     logger.addHandler(hdlr)
     return logger
 
-def get_tactics(tactics_file: str) -> Generator[str, None, None]:
+def get_tactics(tactics_file: str, costs: Optional[Dict] = None) -> Generator[str, None, None]:
     "Generator for list of tactic text strings"
 
     prolog_parser = create_parser()
@@ -151,7 +312,7 @@ def get_tactics(tactics_file: str) -> Generator[str, None, None]:
                 logger.error(f'Parsing error on {line}')
                 continue
             logger.debug(tactic)
-            tactic_text = parse_result_to_str(tactic)
+            tactic_text = parse_result_to_str(tactic, costs)
             logger.debug(tactic_text)
             yield tactic_text
 
@@ -180,51 +341,71 @@ def main():
     elif args.pgn_file:
         positions = positions_pgn(args.pgn_file, args.num_games, args.pos_per_game)
     training_examples = list(positions)
-    tactics = list(get_tactics(args.tactics_file))
+    costs = load_pred_costs(args.pred_costs) if args.pred_costs else None
+    tactics = list(get_tactics(args.tactics_file, costs))
     if args.tactics_limit:
-        tactics = tactic[:args.tactics_limit]
+        tactics = tactics[:args.tactics_limit]
     
     # Calculate metrics for each tactic
     prolog = get_prolog(BK_FILE)
-    metrics_list = []
     random.seed(args.seed)
-    with get_engine(engine_path) as engine:
+    with get_engine(engine_path) as engine, MetricsTable(args.data_path, resume=args.resume) as table:
+        ground_id = table.intern_tactic('ground')
+        random_id = table.intern_tactic('random')
+        sf_id = table.intern_tactic('sf14')
+        m1600_id = table.intern_tactic('maia_1600')
+        tactic_ids = [table.intern_tactic(tactic_text) for tactic_text in tactics]
+
         for board, move, label in tqdm(training_examples, desc='Positions', unit='position'):
-            ground_eval = get_evals(engine, board, [move], mate_score=args.mate_score)[0]
-            ground_metrics = calc_metrics([ground_eval], ground_eval, example=(board, move, label), match=1, tactic_text='ground', prefix='tactic_ground')
-            metrics_list.append(ground_metrics)
+            logger.debug(board)
+            position_id = table.intern_position(board, move)
+            todo = [(tactic_id, tactic_text) for tactic_id, tactic_text in zip(tactic_ids, tactics) if not table.is_done(tactic_id, position_id)]
 
-            random_move = random.choice(list(board.legal_moves))
-            random_eval = get_evals(engine, board, [random_move], mate_score=args.mate_score)[0]
-            random_metrics = calc_metrics([random_eval], ground_eval, example=(board, move, label), match=1, tactic_text='random', prefix='tactic_ground')
-            metrics_list.append(random_metrics)
+            random_move = random.choice(list(board.legal_moves)) # always drawn to keep the random sequence of a resumed run
+            # a resumed run has nothing left to evaluate for this position
+            if not todo and all(table.is_done(baseline_id, position_id) for baseline_id in (ground_id, random_id, sf_id, m1600_id)):
+                continue
 
             # get best moves for engine best move tactics (can't reopen engine)
             sf_best_moves, m1600_best_moves = [], []
-            if args.engine_path == 'STOCKFISH':
-                with get_engine(get_lc0_cmd(LC0, MAIA_1600)) as m1600:
-                    m1600_best_moves = get_top_n_moves(m1600, board, NUM_ENGINE_MOVES) 
-                sf_best_moves = get_top_n_moves(engine, board, NUM_ENGINE_MOVES) 
-            elif args.engine_path == 'MAIA1600':
-                with get_engine(STOCKFISH_15) as sf:
-                    sf_best_moves = get_top_n_moves(sf, board, NUM_ENGINE_MOVES) 
-                m1600_best_moves = get_top_n_moves(engine, board, NUM_ENGINE_MOVES)
-
-            sf_best_move_evals = get_evals(engine, board, sf_best_moves, mate_score=args.mate_score)
-            sf_best_move_metrics = calc_metrics(sf_best_move_evals, ground_eval, example=(board, move, label), match=1, tactic_text='sf14', prefix='tactic_ground')
-            metrics_list.append(sf_best_move_metrics)
-
-            m1600_best_move_evals = get_evals(engine, board, m1600_best_moves, mate_score=args.mate_score)
-            m1600_best_move_metrics = calc_metrics(m1600_best_move_evals, ground_eval, example=(board, move, label), match=1, tactic_text='maia_1600', prefix='tactic_ground')
-            metrics_list.append(m1600_best_move_metrics)
-
-            for tactic_text in tqdm(tactics, desc='Tactics', unit='tactics', leave=False):
-                match, tactic_evals = get_tactic_evals(prolog, tactic_text, board, SUGGESTIONS_PER_TACTIC, engine, args)
-                metrics = calc_metrics(tactic_evals, ground_eval, example=(board, move, label), match=match, tactic_text=tactic_text, prefix='tactic_ground')
-                metrics_list.append(metrics)
+            if not table.is_done(sf_id, position_id) or not table.is_done(m1600_id, position_id):
+                if args.engine_path == 'STOCKFISH':
+                    with get_engine(get_lc0_cmd(LC0, MAIA_1600)) as m1600:
+                        m1600_best_moves = get_top_n_moves(m1600, board, NUM_ENGINE_MOVES) 
+                    sf_best_moves = get_top_n_moves(engine, board, NUM_ENGINE_MOVES) 
+                elif args.engine_path == 'MAIA1600':
+                    with get_engine(STOCKFISH_15) as sf:
+                        sf_best_moves = get_top_n_moves(sf, board, NUM_ENGINE_MOVES) 
+                    m1600_best_moves = get_top_n_moves(engine, board, NUM_ENGINE_MOVES)
+
+            matches = []
+            for tactic_id, tactic_text in tqdm(todo, desc='Tactics', unit='tactics', leave=False):
+                match, suggestions = get_tactic_match(prolog, tactic_text, board, limit=SUGGESTIONS_PER_TACTIC, time_limit_sec=args.eval_timeout)
+                logger.debug(f'Suggestions: {suggestions}')
+                matches.append((tactic_id, match, suggestions if match and suggestions else []))
+
+            # evaluate the moves of the ground truth, the baselines, and every tactic for this position together
+            suggestion_lists = [[move], [random_move], sf_best_moves, m1600_best_moves] + [suggestions for _, _, suggestions in matches]
+            ground_evals, random_evals, sf_best_move_evals, m1600_best_move_evals, *tactic_evals = get_position_evals(engine, board, suggestion_lists, args)
+            ground_eval = ground_evals[0]
+
+            if not table.is_done(ground_id, position_id):
+                table.append(ground_id, position_id, calc_metrics([ground_eval], ground_eval, move, match=1))
+            if not table.is_done(random_id, position_id):
+                table.append(random_id, position_id, calc_metrics(random_evals, ground_eval, move, match=1))
+            if not table.is_done(sf_id, position_id):
+                table.append(sf_id, position_id, calc_metrics(sf_best_move_evals, ground_eval, move, match=1))
+            if not table.is_done(m1600_id, position_id):
+                table.append(m1600_id, position_id, calc_metrics(m1600_best_move_evals, ground_eval, move, match=1))
+
+            for (tactic_id, match, _), evals in zip(matches, tactic_evals):
+                logger.debug(f'Match: {str(match)}, Evals: {str(evals)}')
+                table.append(tactic_id, position_id, calc_metrics(evals, ground_eval, move, match))
+
+            # stream the rows to disk so a crash loses at most one position (CSV) or a few minutes of work (parquet)
+            table.checkpoint()
 
     logger.info(f'% Calculated metrics for {len(tactics)} tactics')
-    write_metrics(metrics_list, args.data_path)
 
 if __name__ == '__main__':
     main()
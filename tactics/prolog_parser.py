@@ -1,5 +1,7 @@
 # Source: https://stackoverflow.com/a/24490005
 
+import json
+
 import pyparsing as pp
 
 
@@ -89,7 +91,9 @@ def to_pred(predicate) -> str:
 def get_pred_str_list(results):
     return [to_pred_str(predicate) for predicate in results]
 
-def sort_pred_list(preds):
+def sort_pred_list(preds, costs=None):
+    if costs:
+        return plan_pred_list(preds, costs)
     N = len(preds)
     grounded = {'A'}
     sorted_pred_list = []
@@ -107,13 +111,45 @@ def sort_pred_list(preds):
                 seen.add(to_pred(pred))
     return sorted_pred_list
 
-def parse_result_to_str(parse_result) -> str:
+def load_pred_costs(path):
+    "Loads the predicate costs Popper saves with --order-by-cost, mapping a predicate to its average solutions and inferences per call"
+
+    with open(path) as f:
+        return json.load(f)
+
+def pred_rank(pred, grounded, costs):
+    "Same rank as popper/planner.py: cheap filters first, expensive generators last"
+
+    if pred.id not in costs:
+        return 0
+    solutions, inferences = costs[pred.id]
+    if get_out_vars(pred).issubset(grounded):
+        solutions = min(solutions, 1)
+    return (solutions - 1) / max(inferences, 1)
+
+def plan_pred_list(preds, costs):
+    "Orders the body predicates cheapest first by the predicate costs Popper samples with --order-by-cost"
+
+    grounded = {'A'}
+    sorted_pred_list = []
+    remaining = list(preds)
+    while remaining:
+        candidates = [pred for pred in remaining if get_in_vars(pred).issubset(grounded)]
+        if not candidates:
+            raise ValueError(f'{",".join(to_pred(pred) for pred in remaining)} could not be grounded')
+        pred = min(candidates, key=lambda pred: pred_rank(pred, grounded, costs))
+        sorted_pred_list.append(pred)
+        grounded.update(get_out_vars(pred))
+        remaining = [other for other in remaining if other is not pred]
+    return sorted_pred_list
+
+def parse_result_to_str(parse_result, costs=None) -> str:
     "Converts a parsed hypothesis space into a list of tactics represented by strings"
 
     head_pred_str = to_pred(parse_result[0])
     body_preds = parse_result[1:]
     # body_preds.sort(key=lambda pred: ''.join(pred.args))
-    body_preds = sort_pred_list(body_preds)
+    body_preds = sort_pred_list(body_preds, costs)
     body_preds_str = ','.join([to_pred(pred) for pred in body_preds])
     tactic_str = f'{head_pred_str}:-{body_preds_str}'
     return tactic_str
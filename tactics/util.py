@@ -2,7 +2,7 @@ import csv
 import logging
 import os
 from contextlib import contextmanager
-from typing import Generator, List, Optional, Tuple, Union
+from typing import Dict, Generator, List, Optional, Tuple, Union
 
 import chess
 import chess.engine
@@ -86,28 +86,74 @@ def chess_examples(chess_exs_path: PathLike) -> Generator[Tuple[chess.Board, che
             label = bool(int(row['label']))
             yield (board, move, label)
 
+def get_move_shortcut(board: chess.Board, move: chess.Move, mate_score: int=MATE_SCORE) -> Optional[int]:
+    "Score a move without the engine if it is illegal or ends the game, otherwise return None"
+
+    if move not in board.legal_moves:
+        return ILLEGAL_MOVE_SCORE
+    board.push(move)
+    try:
+        if board.outcome() is not None:
+            return mate_score if board.is_checkmate() else -mate_score
+        return None
+    finally:
+        board.pop()
+
+def analyse_move(engine: chess.engine.SimpleEngine, board: chess.Board, move: chess.Move, mate_score: int=MATE_SCORE) -> Optional[int]:
+    "Score a move by a one-node analysis of the position after it, or return None if the engine gives no line"
+
+    board.push(move)
+    try:
+        eval = engine.analyse(board, limit=chess.engine.Limit(nodes=1), game=object()) # https://stackoverflow.com/a/66251120
+    finally:
+        board.pop()
+    if 'pv' not in eval:
+        return None
+    return eval['score'].pov(board.turn).score(mate_score=mate_score)
+
+def analyse_root_moves(engine: chess.engine.SimpleEngine, board: chess.Board, moves: List[chess.Move], mate_score: int=MATE_SCORE) -> Dict[chess.Move, int]:
+    "Score moves by a depth-1 search of the position restricted to them, for the moves the engine gives a line for"
+
+    infos = engine.analyse(board, limit=chess.engine.Limit(depth=1), multipv=len(moves), root_moves=moves, game=object())
+    return {info['pv'][0]: info['score'].pov(board.turn).score(mate_score=mate_score) for info in infos if 'pv' in info}
+
 def get_evals(engine: chess.engine.SimpleEngine, board: chess.Board, suggestions: List[chess.Move], mate_score: int=MATE_SCORE) -> List[Tuple[chess.Move, int]]:
-    "Obtain engine evaluations for a list of moves in a given position"
+    "Obtain engine evaluations for a list of moves in a given position, analysing each move on its own"
 
+    root = board.copy(stack=False)
     evals = []
     for move in suggestions:
-        tmp_board = chess.Board(board.fen())
-        if move not in tmp_board.legal_moves:
-            evals.append((move, ILLEGAL_MOVE_SCORE))
-            continue
-        tmp_board.push(move)
-        if tmp_board.outcome() is not None:
-            move_score = mate_score if tmp_board.is_checkmate() else -mate_score
-            evals.append((move, move_score))
-            continue
-        eval = engine.analyse(tmp_board, limit=chess.engine.Limit(nodes=1), game=object()) # https://stackoverflow.com/a/66251120
-        orig_turn = board.turn
-        if 'pv' in eval:
-            curr_score = eval['score'].pov(orig_turn)
-            move_score = curr_score.score(mate_score=mate_score)
+        move_score = get_move_shortcut(root, move, mate_score)
+        if move_score is None:
+            move_score = analyse_move(engine, root, move, mate_score)
+        if move_score is not None:
             evals.append((move, move_score))
     return evals
 
+def get_evals_batch(engine: chess.engine.SimpleEngine, board: chess.Board, suggestion_lists: List[List[chess.Move]], mate_score: int=MATE_SCORE) -> List[List[Tuple[chess.Move, int]]]:
+    "Obtain engine evaluations for several lists of moves in the same position, evaluating each distinct move once"
+
+    root = board.copy(stack=False)
+    scores: Dict[chess.Move, Optional[int]] = {}
+    to_analyse = []
+    for move in dict.fromkeys(move for suggestions in suggestion_lists for move in suggestions):
+        move_score = get_move_shortcut(root, move, mate_score)
+        if move_score is None:
+            to_analyse.append(move)
+        else:
+            scores[move] = move_score
+
+    # one search restricted to the suggested moves, with a line per move
+    if len(to_analyse) > 1 and 'MultiPV' in engine.options:
+        scores.update(analyse_root_moves(engine, root, to_analyse, mate_score))
+    # moves the engine gave no line for, or every move without MultiPV, get the same search on their own
+    # so that all scores are on the same scale
+    for move in to_analyse:
+        if move not in scores:
+            scores[move] = analyse_root_moves(engine, root, [move], mate_score).get(move)
+
+    return [[(move, scores[move]) for move in suggestions if scores[move] is not None] for suggestions in suggestion_lists]
+
 def get_top_n_moves(engine: chess.engine.SimpleEngine, board: chess.Board, n: int) -> List[chess.Move]:
     "Get the top-n engine-recommended moves for a given position"
 
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+# Check that the Datalog evaluator (--datalog) covers the same examples as Prolog on the tasks with Datalog bk
+# e.g. python validate_datalog.py examples/trains* -n 500
+# Tasks whose bk is not Datalog are skipped.
+
+import sys
+import glob
+import argparse
+from popper.util import Settings, format_rule
+from popper.tester import Tester
+from popper.datalog import load_datalog
+from popper.generate import Generator, Grounder
+
+DEFAULT_KBPATHS = sorted(glob.glob('examples/*'))
+
+def generated_rules(settings, n):
+    # the rules of the first programs the generator proposes
+    generator = Generator(settings, Grounder())
+    rules = {}
+    for model in generator.solve():
+        prog, _rule_ordering = generator.parse_model(model.symbols(shown=True))
+        for rule in prog:
+            rules[format_rule(rule)] = rule
+        if len(rules) >= n:
+            break
+    return list(rules.values())[:n]
+
+def validate(kbpath, n):
+    settings = Settings(argv=[kbpath, '-q'])
+    datalog = load_datalog(settings.bk_file)
+    if datalog == None:
+        print(f'{kbpath}: skipped, the bk is not Datalog')
+        return True
+    tester = Tester(settings)
+    datalog.set_examples(tester.pos_index, tester.neg_index)
+
+    checked = 0
+    mismatches = 0
+    for rule in generated_rules(settings, n):
+        covered = datalog.covered(rule)
+        if covered == None:
+            continue
+        checked += 1
+        if covered != tester.rule_covered(rule):
+            mismatches += 1
+            print(f'{kbpath}: different coverage for {format_rule(rule)}')
+    print(f'{kbpath}: {checked} rules checked, {mismatches} different')
+    return mismatches == 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the Datalog evaluator against Prolog')
+    parser.add_argument('kbpaths', nargs='*', default=DEFAULT_KBPATHS, help='Paths to the tasks')
+    parser.add_argument('-n', '--rules', type=int, default=200, help='Number of generated rules to check on each task')
+    args = parser.parse_args()
+    ok = all([validate(kbpath, args.rules) for kbpath in args.kbpaths])
+    sys.exit(0 if ok else 1)